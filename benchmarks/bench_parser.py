@@ -0,0 +1,103 @@
+"""Microbenchmark of frame classification/decoding.
+
+Compares the former per-type regex cascade (valid_packet followed by
+decode_packet, each trying every packet regex in turn) with the single
+pass classify_packet/decode_packet path used by ProtocolBase.
+
+Usage:
+  python benchmarks/bench_parser.py [-n NUMBER]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from iobl.parser import (  # noqa: E402
+    ack_nack_re,
+    bus_command_re,
+    classify_packet,
+    decode_packet,
+    dimension_req_re,
+    dimension_set_re,
+    status_request_re,
+)
+
+FRAMES = [
+    '*2*2*#1975298##',
+    '*1*1*0#13236017##',
+    '*2*1*1975298##',
+    '*#*1##',
+    '*#*0##',
+    '*#1*0#13236017##',
+    '*#1000*1975298*51##',
+    '*#1*1975298*1*100*3##',
+    'garbage##',
+]
+
+
+def legacy_valid_packet(packet):
+    """Packet validation as done before the combined classifier."""
+    return (bool(bus_command_re.match(packet)) |
+            bool(ack_nack_re.match(packet)) |
+            bool(status_request_re.match(packet)) |
+            bool(dimension_req_re.match(packet)) |
+            bool(dimension_set_re.match(packet)))
+
+
+def legacy_classify(packet):
+    """Type lookup as done by the former decode_packet if/elif chain."""
+    if bool(bus_command_re.match(packet)):
+        return bus_command_re.match(packet).group(1, 2, 3)
+    elif bool(ack_nack_re.match(packet)):
+        return ack_nack_re.match(packet).group(1)
+    elif bool(status_request_re.match(packet)):
+        return status_request_re.match(packet).group(1, 2)
+    elif bool(dimension_req_re.match(packet)):
+        return dimension_req_re.match(packet).group(1, 2, 3)
+    elif bool(dimension_set_re.match(packet)):
+        return dimension_set_re.match(packet).group(1, 2)
+
+
+def before():
+    """Validate then classify every frame, former style."""
+    for frame in FRAMES:
+        if legacy_valid_packet(frame):
+            legacy_classify(frame)
+
+
+def after():
+    """Validate and classify every frame in one regex evaluation."""
+    for frame in FRAMES:
+        match = classify_packet(frame)
+        if match:
+            match.lastgroup
+
+
+def after_decode():
+    """Full single pass decoding of every frame."""
+    for frame in FRAMES:
+        match = classify_packet(frame)
+        if match:
+            decode_packet(frame, match)
+
+
+def main():
+    """Run benchmarks and print per frame timings."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in (('before', before), ('after', after),
+                       ('after+decode', after_decode)):
+        best = min(timeit.repeat(func, number=args.number, repeat=5))
+        results[name] = best / (args.number * len(FRAMES)) * 1e9
+        print('%-14s %8.1f ns/frame' % (name, results[name]))
+    print('speedup        %8.2fx' % (results['before'] / results['after']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Compare two benchmark result files written by benchmarks/run.py.
+
+Exits with status 1 when a benchmark got slower than the threshold.
+
+Usage:
+  python benchmarks/compare.py BASELINE.json CURRENT.json [-t 0.1]
+"""
+
+import argparse
+import json
+import sys
+
+
+def main():
+    """Print per benchmark ratio of current to baseline timings."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+
+    print('%-24s %12s %12s %8s' % (
+        'benchmark', baseline.get('revision') or 'baseline',
+        current.get('revision') or 'current', 'ratio'))
+    regressions = []
+    for name in sorted(set(baseline['results']) | set(current['results'])):
+        before = baseline['results'].get(name)
+        after = current['results'].get(name)
+        if before is None or after is None:
+            print('%-24s %12s %12s' % (
+                name, '-' if before is None else '%.1f' % before['ns_per_op'],
+                '-' if after is None else '%.1f' % after['ns_per_op']))
+            continue
+        ratio = after['ns_per_op'] / before['ns_per_op']
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = ' slower'
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = ' faster'
+        print('%-24s %10.1fns %10.1fns %7.2fx%s' % (
+            name, before['ns_per_op'], after['ns_per_op'], ratio, flag))
+
+    if regressions:
+        print('regressions: %s' % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
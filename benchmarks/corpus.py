@@ -0,0 +1,87 @@
+"""Realistic mixed-frame corpus for the benchmarks.
+
+Covers every frame type (bus_command, ack/nack, status_request,
+dimension_request, dimension_set) and every devicetype code, with a
+traffic mix dominated by bus commands as seen on a busy PLC bus.
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from iobl.parser import (  # noqa: E402
+    command_tables,
+    devicetype,
+    dimension_tables,
+    encode_where,
+)
+
+SEED = 88213
+# relative weight of every frame type in the corpus
+MIX = (
+    ('bus_command', 60),
+    ('ack', 10),
+    ('nack', 1),
+    ('status_request', 9),
+    ('dimension_request', 15),
+    ('dimension_set', 4),
+    ('invalid', 1),
+)
+MODES = ('unicast', 'unicast', 'unicast', 'multicast', 'broadcast')
+MEDIAS = ('plc', 'plc', 'plc', 'rf', 'ir')
+
+
+def make_devices(rng, count=300):
+    """Return (who code, legrand_id, unit) of a site device population."""
+    codes = sorted(devicetype)
+    return [(codes[i % len(codes)], str(rng.randint(100000, 999999)),
+             str(rng.randint(1, 9)))
+            for i in range(count)]
+
+
+def make_frame(rng, frame_type, device):
+    """Return one frame of frame_type for device."""
+    code, legrand_id, unit = device
+    who = devicetype[code]
+    where = encode_where(legrand_id, unit, rng.choice(MODES), rng.choice(MEDIAS))
+
+    if frame_type == 'bus_command':
+        table = command_tables.get(who)
+        what = rng.choice(sorted(table[0])) if table else str(rng.randint(0, 99))
+        if table and table[1] and rng.random() < 0.3:
+            what += '#' + str(rng.randint(1, 9))
+        return '*%s*%s*%s##' % (code, what, where)
+    if frame_type == 'ack':
+        return '*#*1##'
+    if frame_type == 'nack':
+        return '*#*0##'
+    if frame_type == 'status_request':
+        return '*#%s*%s##' % (code, where)
+    dimensions = sorted(dimension_tables.get(who, {'1': None}))
+    dimension = rng.choice(dimensions)
+    if frame_type == 'dimension_request':
+        values = ''.join('*%d' % rng.randint(0, 255)
+                         for _ in range(rng.randint(0, 4)))
+        return '*#%s*%s*%s%s##' % (code, where, dimension, values)
+    if frame_type == 'dimension_set':
+        return '*#%s*%s*#%s##' % (code, where, dimension)
+    return '*%s*garbage%d##' % (code, rng.randint(0, 9))
+
+
+def make_corpus(size=10000, seed=SEED):
+    """Return list of size frames, deterministic for a given seed."""
+    rng = random.Random(seed)
+    devices = make_devices(rng)
+    types = [frame_type for frame_type, weight in MIX for _ in range(weight)]
+
+    corpus = []
+    # every frame type for every device class first, then the traffic mix
+    for code in sorted(devicetype):
+        device = next(device for device in devices if device[0] == code)
+        for frame_type, _ in MIX:
+            corpus.append(make_frame(rng, frame_type, device))
+    while len(corpus) < size:
+        corpus.append(make_frame(rng, rng.choice(types), rng.choice(devices)))
+    return corpus[:size]
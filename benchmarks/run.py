@@ -0,0 +1,215 @@
+"""Benchmark suite for parser, framing and protocol throughput.
+
+Results are printed and optionally written as JSON, to be compared
+between commits with benchmarks/compare.py.
+
+Usage:
+  python benchmarks/run.py [-o results.json] [--quick] [-k NAME]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from corpus import make_corpus  # noqa: E402
+from iobl.parser import (  # noqa: E402
+    classify_packet,
+    decode_packet,
+    encode_packet,
+    encode_where,
+    parse_dimension,
+    parse_legrand_id,
+    valid_packet,
+)
+from iobl.protocol import IoblProtocol, ProtocolBase  # noqa: E402
+
+# size of the chunks the end to end benchmarks feed the protocol with
+CHUNK_SIZE = 4096
+# where token group of every packet type in iobl.parser.PACKET
+WHERE_GROUPS = {
+    'bus_command': 'bc_where',
+    'status_request': 'sr_where',
+    'dimension_request': 'dr_where',
+    'dimension_set': 'ds_where',
+}
+
+
+class MemoryTransport(asyncio.Transport):
+    """In-memory transport, discarding writes."""
+
+    def write(self, data):
+        """Discard data."""
+
+    def pause_reading(self):
+        """Nothing to pause."""
+
+    def resume_reading(self):
+        """Nothing to resume."""
+
+
+class FramingProtocol(ProtocolBase):
+    """Protocol stopping right after framing and classification."""
+
+    def handle_raw_packet(self, raw_packet, match=None):
+        """Drop packet."""
+
+
+def chunks(corpus):
+    """Return corpus as a list of CHUNK_SIZE byte chunks."""
+    data = ''.join(corpus).encode()
+    return [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+def make_benchmarks(corpus):
+    """Return name -> (function, operations per call) of every benchmark."""
+    matches = [(frame, classify_packet(frame)) for frame in corpus]
+    valid = [(frame, match) for frame, match in matches if match]
+    wheres = [match.group(WHERE_GROUPS[match.lastgroup]) for _, match in valid
+              if match.lastgroup in WHERE_GROUPS]
+    dimensions = [match.group('dr_dimension') for _, match in valid
+                  if match.lastgroup == 'dimension_request']
+    decoded = [decode_packet(frame, match) for frame, match in valid]
+    fields = []
+    for packet in decoded:
+        if packet.type == 'bus_command' and packet.what and packet.media:
+            fields.append(dict(packet, values=None))
+    where_args = [(field['legrand_id'], field['unit'], field['mode'], field['media'])
+                  for field in fields]
+    data = chunks(corpus)
+    loop = asyncio.new_event_loop()
+
+    def bench_valid_packet():
+        for frame in corpus:
+            valid_packet(frame)
+
+    def bench_classify_packet():
+        for frame in corpus:
+            classify_packet(frame)
+
+    def bench_decode_packet():
+        for frame, match in valid:
+            decode_packet(frame, match)
+
+    def bench_decode_packet_unmatched():
+        for frame, _ in valid:
+            decode_packet(frame)
+
+    def bench_parse_legrand_id():
+        for where in wheres:
+            parse_legrand_id(where)
+
+    def bench_parse_dimension():
+        for dimension in dimensions:
+            parse_dimension(dimension)
+
+    def bench_encode_packet():
+        for field in fields:
+            encode_packet(field)
+
+    def bench_encode_where():
+        for args in where_args:
+            encode_where(*args)
+
+    def bench_framing():
+        protocol = FramingProtocol(loop=loop)
+        protocol.connection_made(MemoryTransport())
+        for chunk in data:
+            protocol.data_received(chunk)
+
+    def bench_protocol():
+        events = []
+        protocol = IoblProtocol(loop=loop, event_callback=events.append,
+                                packet_callback=lambda packet: None)
+        protocol.connection_made(MemoryTransport())
+        for chunk in data:
+            protocol.data_received(chunk)
+
+    def bench_protocol_raw_only():
+        frames = []
+        protocol = IoblProtocol(loop=loop, raw_callback=frames.append,
+                                decode_packets=False)
+        protocol.connection_made(MemoryTransport())
+        for chunk in data:
+            protocol.data_received(chunk)
+
+    return {
+        'valid_packet': (bench_valid_packet, len(corpus)),
+        'classify_packet': (bench_classify_packet, len(corpus)),
+        'decode_packet': (bench_decode_packet, len(valid)),
+        'decode_packet_unmatched': (bench_decode_packet_unmatched, len(valid)),
+        'parse_legrand_id': (bench_parse_legrand_id, len(wheres)),
+        'parse_dimension': (bench_parse_dimension, len(dimensions)),
+        'encode_packet': (bench_encode_packet, len(fields)),
+        'encode_where': (bench_encode_where, len(where_args)),
+        'framing': (bench_framing, len(corpus)),
+        'protocol_end_to_end': (bench_protocol, len(corpus)),
+        'protocol_raw_only': (bench_protocol_raw_only, len(corpus)),
+    }
+
+
+def git_revision():
+    """Return current git revision, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run benchmarks, print and optionally save results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='write JSON results to file')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller corpus and fewer repeats')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of frames in corpus')
+    args = parser.parse_args()
+
+    # the corpus has invalid frames on purpose, don't print them
+    logging.getLogger('iobl').setLevel(logging.ERROR)
+
+    size = 2000 if args.quick else args.size
+    repeat = 3 if args.quick else 7
+    corpus = make_corpus(size)
+
+    results = {}
+    for name, (func, operations) in sorted(make_benchmarks(corpus).items()):
+        if args.filter not in name:
+            continue
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        results[name] = {
+            'ns_per_op': best / operations * 1e9,
+            'ops_per_s': operations / best,
+            'operations': operations,
+        }
+        print('%-24s %10.1f ns/op %12.0f ops/s' % (
+            name, results[name]['ns_per_op'], results[name]['ops_per_s']))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'revision': git_revision(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'corpus_size': size,
+                'results': results,
+            }, file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
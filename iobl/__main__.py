@@ -3,6 +3,10 @@
 Usage:
   iobl [-v | -vv] [options]
   iobl [-v | -vv] [options] [commands [optionnal command args]]
+  iobl [-v | -vv] [options] replay <file>
+  iobl [-v | -vv] [options] daemon
+  iobl [-v | -vv] [options] run <file>
+  iobl [-v | -vv] [options] decode <file>
   iobl (-h | --help)
   iobl --version
 
@@ -11,6 +15,21 @@ Options:
                            or TCP port in TCP mode.
   --baud=<baud>          Serial baud rate [default: 115200].
   --host=<host>          TCP mode, connect to host instead of serial port.
+  --record=<file>        Append received frames to capture file (gzip
+                           compressed if ending with .gz).
+  --speed=<speed>        Replay speed factor, 0 for as fast as possible
+                           [default: 1].
+  --stats                Collect runtime metrics, printed on exit.
+  --raw                  Print received frames as is, without decoding them.
+  --socket=<path>        Unix socket of the daemon, listened on in daemon
+                           mode; commands are sent through the daemon when
+                           given.
+  --in-flight=<count>    Commands awaiting their ack at once in run mode
+                           [default: 4].
+  --workers=<count>      Processes decoding in decode mode, 0 to decode in
+                           the main process [default: 0].
+  --export=<file>        In decode mode, save decoded frames as columns in
+                           a NumPy .npz file instead of printing them.
   -h --help              Show this screen.
   -v                     Increase verbosity
   --version              Show version.
@@ -27,26 +46,13 @@ Optionnal command args:
 
 """
 
-import asyncio
 import logging
 import sys
 
 from typing import Any, Dict, cast
-import pkg_resources
-from docopt import docopt
 
-from .protocol import (
-    EventHandling,
-    PacketHandling,
-    IoblProtocol,
-    create_iobl_connection
-)
-
-PROTOCOLS = {
-    'command': IoblProtocol,
-    'event': EventHandling,
-    'print': PacketHandling,
-}
+# protocol, asyncio, docopt and pkg_resources are imported when needed, so
+# that commands sent through the daemon start fast
 
 
 def print_callback(packet):
@@ -54,10 +60,145 @@ def print_callback(packet):
     print(packet)
 
 
+def command_fields(args) -> Dict[str, Any]:
+    """Return packet fields of the command given on the command line."""
+    if args['--comm_mode'] is None:
+        args['--comm_mode'] = 'unicast'
+    if args['--comm_media'] is None:
+        args['--comm_media'] = 'plc'
+
+    if args['--dimension']:
+        data = cast(Dict[str, Any], {
+            'type': 'set_dimension',
+            'legrand_id': args['--legrand_id'],
+            'who': args['--who'],
+            'mode': args['--comm_mode'],
+            'media': args['--comm_media'],
+            'unit': args['--unit'],
+            'dimension': args['--what'],
+        })
+        val = list()
+        for value in args['--val'].split(','):
+            val.append(value)
+
+        data['values'] = val
+
+    else:
+        data = cast(Dict[str, Any], {
+            'type': 'bus_command',
+            'legrand_id': args['--legrand_id'],
+            'who': args['--who'],
+            'mode': args['--comm_mode'],
+            'media': args['--comm_media'],
+            'unit': args['--unit'],
+            'what': args['--what'],
+        })
+    return data
+
+
+def send_through_daemon(args) -> int:
+    """Send command line command through the daemon, return exit status."""
+    from .client import DaemonError, send_packet
+    try:
+        send_packet(command_fields(args), args['--socket'])
+    except (OSError, DaemonError) as exc:
+        logging.error('command failed: %s', exc)
+        return 1
+    return 0
+
+
+def run_daemon(args, loop, **kwargs):
+    """Serve commands on the daemon socket until interrupted."""
+    import signal
+    from .client import SOCKET_PATH
+    from .daemon import Daemon
+
+    daemon = Daemon(args['--socket'] or SOCKET_PATH, loop=loop, **kwargs)
+    loop.run_until_complete(daemon.start())
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+def decode(args) -> int:
+    """Print decoded frames of a capture file or raw frame log as JSON lines."""
+    import json
+    from .decoder import decode_file
+    from .metrics import Metrics
+
+    metrics = Metrics()
+    decoded = decode_file(args['<file>'], int(args['--workers']), metrics)
+    if args['--export']:
+        from .columnar import ColumnarTable
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            logging.error('--export needs numpy')
+            return 1
+        table = ColumnarTable()
+        table.extend(decoded)
+        table.save(args['--export'])
+        decoded = ()
+
+    try:
+        for timestamp, frame, packet in decoded:
+            data = packet.to_dict()
+            data['time'] = timestamp
+            data['frame'] = frame
+            print(json.dumps(data))
+    except BrokenPipeError:
+        # output piped to head or the like
+        return 0
+    print('frames: %d, decoded: %d, invalid: %d' % (
+        metrics.frames_received, metrics.frames_decoded,
+        metrics.frames_invalid), file=sys.stderr)
+    return 0
+
+
+def run_file(args, loop, **kwargs) -> int:
+    """Send the commands of a command file, return exit status."""
+    from .batch import encode_commands, format_report, load_commands, run_commands
+    from .protocol import create_iobl_connection
+
+    commands = load_commands(args['<file>'])
+    errors = encode_commands(commands)
+    if errors:
+        for error in errors:
+            logging.error(error)
+        return 1
+
+    in_flight = int(args['--in-flight'])
+    transport, protocol = loop.run_until_complete(create_iobl_connection(
+        loop=loop, window=in_flight, **kwargs))
+    try:
+        loop.run_until_complete(run_commands(protocol, commands, in_flight))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        if kwargs.get('recorder'):
+            kwargs['recorder'].close()
+        if kwargs.get('metrics'):
+            print(kwargs['metrics'].format(), file=sys.stderr)
+        loop.close()
+
+    print(format_report(commands))
+    return 0 if all(command.outcome == 'ack' for command in commands) else 1
+
+
 def main(argv=sys.argv[1:], loop=None):
     """Parse argument and setup main program loop."""
-    args = docopt(__doc__, argv=argv,
-                  version=pkg_resources.require('iobl')[0].version)
+    from docopt import docopt
+
+    version = None
+    if '--version' in argv:
+        import pkg_resources
+        version = pkg_resources.require('iobl')[0].version
+    args = docopt(__doc__, argv=argv, version=version)
 
     level = logging.ERROR
     if args['-v']:
@@ -66,64 +207,107 @@ def main(argv=sys.argv[1:], loop=None):
         level = logging.DEBUG
     logging.basicConfig(level=level)
 
+    if (args['--socket'] and not args['daemon'] and
+            args.get('--legrand_id') is not None):
+        return send_through_daemon(args)
+
+    if args['decode']:
+        return decode(args)
+
+    import asyncio
+    from .capture import FrameRecorder, create_replay_connection
+    from .metrics import Metrics
+    from .protocol import CommandError, IoblProtocol, create_iobl_connection
+
     if not loop:
         loop = asyncio.get_event_loop()
 
-    protocol = PROTOCOLS['command']
+    protocol = IoblProtocol
+
+    recorder = None
+    if args['--record']:
+        recorder = FrameRecorder(args['--record'])
+
+    metrics = Metrics() if args['--stats'] else None
+
+    raw_options = {}
+    if args['--raw']:
+        raw_options = {'raw_callback': print, 'decode_packets': False}
 
-    conn = create_iobl_connection(
-        protocol=protocol,
-        host=args['--host'],
-        port=args['--port'],
-        baud=args['--baud'],
-        loop=loop,
-        ignore=None,
-        packet_callback=print_callback,
-    )
+    if args['run']:
+        return run_file(args, loop, protocol=protocol, host=args['--host'],
+                        port=args['--port'], baud=args['--baud'],
+                        recorder=recorder, metrics=metrics)
+
+    if args['daemon']:
+        try:
+            run_daemon(args, loop, protocol=protocol, host=args['--host'],
+                       port=args['--port'], baud=args['--baud'],
+                       recorder=recorder, metrics=metrics)
+        finally:
+            if recorder:
+                recorder.close()
+            if metrics:
+                print(metrics.format(), file=sys.stderr)
+            loop.close()
+        return
+
+    # resolved once the connection is lost, so that exiting waits for it
+    closed = asyncio.Future(loop=loop)
+
+    def disconnected(exc):
+        """Resolve closed."""
+        if not closed.done():
+            closed.set_result(exc)
+
+    if args['replay']:
+        conn = create_replay_connection(
+            args['<file>'],
+            protocol=protocol,
+            speed=float(args['--speed']),
+            loop=loop,
+            ignore=None,
+            packet_callback=print_callback,
+            disconnect_callback=disconnected,
+            recorder=recorder,
+            metrics=metrics,
+            **raw_options
+        )
+    else:
+        conn = create_iobl_connection(
+            protocol=protocol,
+            host=args['--host'],
+            port=args['--port'],
+            baud=args['--baud'],
+            loop=loop,
+            ignore=None,
+            packet_callback=print_callback,
+            disconnect_callback=disconnected,
+            recorder=recorder,
+            metrics=metrics,
+            **raw_options
+        )
 
     transport, protocol = loop.run_until_complete(conn)
 
     try:
-        if not args.get('--legrand_id') is None:
-            if args['--comm_mode'] is None:
-                args['--comm_mode'] = 'unicast'
-            if args['--comm_media'] is None:
-                args['--comm_media'] = 'plc'
-
-            if args['--dimension']:
-                data = cast(Dict[str, Any], {
-                    'type': 'set_dimension',
-                    'legrand_id': args['--legrand_id'],
-                    'who': args['--who'],
-                    'mode': args['--comm_mode'],
-                    'media': args['--comm_media'],
-                    'unit': args['--unit'],
-                    'dimension': args['--what'],
-                })
-                val = list()
-                for value in args['--val'].split(','):
-                    val.append(value)
-
-                data['values'] = val
-
-            else:
-                data = cast(Dict[str, Any], {
-                    'type': 'bus_command',
-                    'legrand_id': args['--legrand_id'],
-                    'who': args['--who'],
-                    'mode': args['--comm_mode'],
-                    'media': args['--comm_media'],
-                    'unit': args['--unit'],
-                    'what': args['--what'],
-                })
-
-            loop.run_until_complete(
-                protocol.send_packet(data))
+        if args['replay']:
+            loop.run_until_complete(transport.done)
+        elif not args.get('--legrand_id') is None:
+            try:
+                loop.run_until_complete(
+                    protocol.send_packet(command_fields(args)))
+            except CommandError as exc:
+                logging.error('command failed: %s', exc)
         else:
-            loop.run_forever()
+            loop.run_until_complete(closed)
     except KeyboardInterrupt:
         # cleanup connection
         transport.close()
-        loop.run_forever()
+        loop.run_until_complete(closed)
     finally:
+        if recorder:
+            recorder.close()
+        if metrics:
+            print(metrics.format(), file=sys.stderr)
         loop.close()
@@ -0,0 +1,161 @@
+"""Bulk execution of command files.
+
+A command file is either JSON or CSV (by extension). JSON files hold a
+list of commands, given as packet fields plus optional 'delay' and
+'group' keys; a nested list is a group of its own. CSV files have one
+command per row, with a header naming the same fields, 'values' being
+comma separated.
+
+Commands are encoded before anything is sent, then sent in order with a
+bounded number of them awaiting their ack. 'delay' pauses for that many
+seconds before sending a command; commands with the same consecutive
+'group' are sent together, a new group starting once all commands of the
+previous one are answered.
+"""
+import asyncio
+import csv
+import json
+from typing import List
+
+from .parser import encode_packet
+from .protocol import CommandError, CommandNack, CommandTimeout
+
+# commands sent at once without waiting for their ack
+IN_FLIGHT = 4
+# packet fields read from command files, besides delay/group
+FIELDS = ('type', 'who', 'what', 'legrand_id', 'unit', 'mode', 'media',
+          'dimension', 'values')
+
+
+class Command:
+    """Command of a command file, and its outcome once run."""
+
+    __slots__ = ('index', 'fields', 'delay', 'group', 'packet', 'outcome',
+                 'error', 'started', 'elapsed')
+
+    def __init__(self, index: int, fields: dict, delay: float = 0,
+                 group=None) -> None:
+        """Initialize command, index being its position in the file."""
+        self.index = index
+        self.fields = fields
+        self.delay = delay
+        self.group = group
+        self.packet = None  # type: str
+        self.outcome = None  # type: str
+        self.error = None  # type: str
+        self.started = None  # type: float
+        self.elapsed = None  # type: float
+
+
+def make_command(index: int, entry: dict, group=None) -> Command:
+    """Build command out of a file entry, filling in CLI defaults."""
+    fields = {key: entry[key] for key in FIELDS
+              if entry.get(key) not in (None, '')}
+    for key in ('legrand_id', 'unit'):
+        if key in fields:
+            fields[key] = str(fields[key])
+    if 'values' in fields:
+        values = fields['values']
+        if isinstance(values, str):
+            values = values.split(',')
+        fields['values'] = [str(value) for value in values]
+    fields.setdefault('type', 'set_dimension' if 'dimension' in fields
+                      else 'bus_command')
+    fields.setdefault('mode', 'unicast')
+    fields.setdefault('media', 'plc')
+    return Command(index, fields, float(entry.get('delay') or 0),
+                   entry.get('group', group) or group)
+
+
+def load_commands(path: str) -> List[Command]:
+    """Read command file, CSV if path ends with .csv, JSON otherwise."""
+    commands = []
+    with open(path, newline='') as file:
+        if path.endswith('.csv'):
+            for entry in csv.DictReader(file):
+                commands.append(make_command(len(commands), entry))
+            return commands
+
+        entries = json.load(file)
+    if not isinstance(entries, list):
+        raise ValueError('%s: expected a list of commands' % path)
+    for position, entry in enumerate(entries):
+        if isinstance(entry, list):
+            # nested lists are anonymous groups
+            for member in entry:
+                commands.append(make_command(len(commands), member,
+                                             group=('#', position)))
+        else:
+            commands.append(make_command(len(commands), entry))
+    return commands
+
+
+def encode_commands(commands: List[Command]) -> List[str]:
+    """Encode every command, return errors of those that can't be."""
+    errors = []
+    for command in commands:
+        try:
+            command.packet = encode_packet(command.fields)
+        except (ValueError, KeyError, TypeError) as exc:
+            errors.append('command %d: %s' % (command.index + 1, exc))
+        else:
+            if not command.packet:
+                errors.append('command %d: unknown type %r' % (
+                    command.index + 1, command.fields.get('type')))
+    return errors
+
+
+@asyncio.coroutine
+def run_commands(protocol, commands: List[Command], in_flight: int = IN_FLIGHT):
+    """Send encoded commands through protocol, recording their outcome."""
+    loop = protocol.loop
+    slots = asyncio.Semaphore(in_flight)
+    pending = set()  # type: set
+    group = None
+
+    @asyncio.coroutine
+    def send(command):
+        command.started = loop.time()
+        try:
+            yield from protocol.send_acknowledged(command.packet)
+            command.outcome = 'ack'
+        except CommandNack as exc:
+            command.outcome, command.error = 'nack', str(exc)
+        except CommandTimeout as exc:
+            command.outcome, command.error = 'timeout', str(exc)
+        except CommandError as exc:
+            command.outcome, command.error = 'error', str(exc)
+        finally:
+            command.elapsed = loop.time() - command.started
+            slots.release()
+
+    for command in commands:
+        if command.group != group and pending:
+            # previous group must be over before starting the next one
+            yield from asyncio.wait(pending)
+            pending.clear()
+        group = command.group
+        if command.delay:
+            yield from asyncio.sleep(command.delay)
+        yield from slots.acquire()
+        pending.add(loop.create_task(send(command)))
+        pending = {task for task in pending if not task.done()}
+
+    if pending:
+        yield from asyncio.wait(pending)
+    return commands
+
+
+def format_report(commands: List[Command]) -> str:
+    """Return per command outcome and timing, and totals."""
+    lines = []
+    totals = {}  # type: dict
+    for command in commands:
+        outcome = command.outcome or 'not sent'
+        totals[outcome] = totals.get(outcome, 0) + 1
+        elapsed = '%8.3fs' % command.elapsed if command.elapsed is not None else ''
+        lines.append('%4d %-8s %9s %-32s %s' % (
+            command.index + 1, outcome, elapsed, command.packet or '',
+            command.error or ''))
+    lines.append(', '.join('%s: %d' % item for item in sorted(totals.items())))
+    return '\n'.join(line.rstrip() for line in lines)
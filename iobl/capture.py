@@ -0,0 +1,178 @@
+"""Raw frame capture and replay.
+
+Capture files start with MAGIC, followed by one record per frame: a
+little endian float64 timestamp (seconds since epoch), a uint16 frame
+length and the raw frame bytes. Files may be gzip compressed.
+"""
+import asyncio
+import gzip
+import logging
+import os
+import struct
+import time
+from typing import Iterator, Tuple
+
+from .protocol import IoblProtocol, loop_argument
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'IOBLCAP1'
+RECORD = struct.Struct('<dH')
+GZIP_MAGIC = b'\x1f\x8b'
+# frames replayed between two yields to the loop at maximum speed
+REPLAY_BATCH = 256
+
+
+class FrameRecorder:
+    """Append timestamped raw frames to a capture file."""
+
+    def __init__(self, path: str, compress: bool = None) -> None:
+        """Open capture file for appending.
+
+        compress: gzip compress the file, by default when path ends
+        with '.gz'.
+        """
+        if compress is None:
+            compress = path.endswith('.gz')
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if compress:
+            self.file = gzip.open(path, 'ab')
+        else:
+            self.file = open(path, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        self.frames = 0
+
+    def record(self, frame: bytes, timestamp: float = None) -> None:
+        """Append one frame."""
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(RECORD.pack(timestamp, len(frame)))
+        self.file.write(frame)
+        self.frames += 1
+
+    def close(self) -> None:
+        """Flush and close capture file."""
+        self.file.close()
+
+
+def open_capture(path: str):
+    """Open capture file for reading, compressed or not."""
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_frames(path: str) -> Iterator[Tuple[float, bytes]]:
+    """Yield (timestamp, frame) of every record of a capture file."""
+    with open_capture(path) as file:
+        read = file.read
+        header = read(len(MAGIC))
+        if header != MAGIC:
+            raise ValueError('%s is not an iobl capture file' % path)
+        while True:
+            head = read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            timestamp, length = RECORD.unpack(head)
+            yield timestamp, read(length)
+
+
+class ReplayTransport(asyncio.Transport):
+    """Transport feeding a protocol with the frames of a capture file.
+
+    speed: replay speed factor, relative to the recorded timing; 0 to
+    replay as fast as possible. Written data is discarded.
+    """
+
+    def __init__(self, loop, protocol, path: str, speed: float = 1) -> None:
+        """Initialize transport."""
+        super().__init__()
+        self.loop = loop
+        self.protocol = protocol
+        self.path = path
+        self.speed = speed
+        self.frames = 0
+        self._closing = False
+        self._resumed = asyncio.Event(**loop_argument(loop))
+        self._resumed.set()
+        self.done = asyncio.Future(loop=loop)
+        self._task = None  # type: asyncio.Task
+
+    def start(self):
+        """Connect protocol and start replaying."""
+        self.protocol.connection_made(self)
+        self._task = self.loop.create_task(self._replay())
+
+    @asyncio.coroutine
+    def _replay(self):
+        """Feed frames to protocol with recorded timing."""
+        exc = None
+        try:
+            start = None
+            origin = self.loop.time()
+            for timestamp, frame in read_frames(self.path):
+                if self._closing:
+                    break
+                if self.speed:
+                    if start is None:
+                        start = timestamp
+                    delay = origin + (timestamp - start) / self.speed - self.loop.time()
+                    if delay > 0:
+                        yield from asyncio.sleep(delay)
+                elif self.frames % REPLAY_BATCH == 0:
+                    yield from asyncio.sleep(0)
+                # after sleeping, reading may have been paused meanwhile
+                if not self._resumed.is_set():
+                    yield from self._resumed.wait()
+                if self._closing:
+                    break
+                self.protocol.data_received(frame)
+                self.frames += 1
+        except Exception as error:
+            log.exception('replay of %s failed', self.path)
+            exc = error
+        finally:
+            self._closing = True
+            self.protocol.connection_lost(exc)
+            if not self.done.done():
+                self.done.set_result(self.frames)
+
+    def write(self, data):
+        """Discard written data."""
+        log.debug('replay discarding written data: %r', data)
+
+    def pause_reading(self):
+        """Stop feeding frames until resume_reading()."""
+        self._resumed.clear()
+
+    def resume_reading(self):
+        """Resume feeding frames."""
+        self._resumed.set()
+
+    def is_closing(self):
+        """Return whether transport is closing or closed."""
+        return self._closing
+
+    def close(self):
+        """Stop replaying."""
+        self._closing = True
+        self._resumed.set()
+
+
+@asyncio.coroutine
+def create_replay_connection(path: str, protocol=IoblProtocol,
+                             speed: float = 1, loop=None, **kwargs):
+    """Drive a protocol from a capture file, returns (transport, protocol).
+
+    Keyword arguments are passed on to the protocol, as by
+    create_iobl_connection. transport.done resolves to the number of frames
+    replayed once the file is exhausted.
+    """
+    loop = loop if loop else asyncio.get_event_loop()
+    instance = protocol(loop=loop, **kwargs)
+    transport = ReplayTransport(loop, instance, path, speed)
+    transport.start()
+    return transport, instance
@@ -0,0 +1,70 @@
+"""Client of the iobl daemon.
+
+Kept free of asyncio and serial imports, so that one-shot commands start
+fast. Requests and answers are JSON objects, one per line: the request is
+the packet fields as given to send_packet, the answer holds either
+'result' (the gateway answer type) or 'error' and 'message'.
+"""
+import json
+import os
+import socket
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'iobl.sock')
+# seconds to wait for the daemon answer, which includes the gateway ack
+CLIENT_TIMEOUT = 30
+
+
+class DaemonError(Exception):
+    """Daemon failed to send a command, error is 'nack', 'timeout'..."""
+
+    def __init__(self, error: str, message: str) -> None:
+        """Initialize exception."""
+        super().__init__(message)
+        self.error = error
+
+
+class DaemonClient:
+    """Connection to the daemon, to send several commands through."""
+
+    def __init__(self, path: str = SOCKET_PATH,
+                 timeout: float = CLIENT_TIMEOUT) -> None:
+        """Connect to daemon socket."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rwb')
+
+    def send_packet(self, fields: dict) -> str:
+        """Send packet through the daemon, return the gateway answer.
+
+        Raises DaemonError when the command failed.
+        """
+        self.file.write(json.dumps(fields).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise DaemonError('closed', 'daemon closed the connection')
+        answer = json.loads(line.decode())
+        if 'error' in answer:
+            raise DaemonError(answer['error'], answer.get('message', ''))
+        return answer['result']
+
+    def close(self) -> None:
+        """Close connection."""
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        """Use as context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close on context exit."""
+        self.close()
+
+
+def send_packet(fields: dict, path: str = SOCKET_PATH,
+                timeout: float = CLIENT_TIMEOUT) -> str:
+    """Send a single packet through the daemon, see DaemonClient.send_packet."""
+    with DaemonClient(path, timeout) as client:
+        return client.send_packet(fields)
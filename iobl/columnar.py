@@ -0,0 +1,138 @@
+"""Columnar storage of decoded packets, for vectorised analysis.
+
+Packets are stored as one typed array per field: string fields are
+dictionary encoded (small integer codes into a per column list of values,
+-1 for None), legrand_id and unit are stored as integers (-1 when
+missing) and dimension values are flattened into val_values, the values
+of row i being val_values[val_offsets[i]:val_offsets[i + 1]].
+
+Columns are stdlib arrays; NumPy is only needed for to_numpy()/save().
+"""
+from array import array
+from typing import Dict, Iterable, List
+
+from .parser import (
+    Packet,
+    command_tables,
+    communication_media,
+    communication_mode,
+    devicetype
+)
+
+# dictionary encoded columns, with the values known upfront so that codes
+# are the same from one export to the other
+DICTIONARY_COLUMNS = {
+    'type': sorted(Packet.keys_by_type),
+    'who': sorted(devicetype.values()),
+    'what': sorted({name for table, _ in command_tables.values()
+                    for name in table.values()}),
+    'mode': sorted(set(communication_mode.values())),
+    'media': sorted(set(communication_media.values())),
+    'dimension': [],
+}
+# row columns and their array typecode
+COLUMNS = (
+    ('time', 'd'),
+    ('type', 'b'),
+    ('who', 'h'),
+    ('what', 'h'),
+    ('legrand_id', 'q'),
+    ('unit', 'h'),
+    ('mode', 'h'),
+    ('media', 'h'),
+    ('dimension', 'h'),
+)
+# numpy dtypes of the array typecodes
+NUMPY_TYPES = {'d': 'f8', 'b': 'i1', 'h': 'i2', 'q': 'i8'}
+
+
+class ColumnarTable:
+    """Decoded packets stored column by column."""
+
+    def __init__(self) -> None:
+        """Initialize empty table."""
+        self.columns = {name: array(code) for name, code in COLUMNS}
+        self.val_offsets = array('q', [0])
+        self.val_values = array('q')
+        self.dictionaries = {name: list(values) for name, values
+                             in DICTIONARY_COLUMNS.items()}
+        self._codes = {name: {value: code for code, value in enumerate(values)}
+                       for name, values in self.dictionaries.items()}
+
+    def __len__(self):
+        """Return number of rows."""
+        return len(self.columns['time'])
+
+    def encode(self, name: str, value) -> int:
+        """Return code of value in a dictionary column, adding it if new."""
+        if value is None:
+            return -1
+        codes = self._codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.dictionaries[name])
+            self.dictionaries[name].append(value)
+        return code
+
+    def append(self, packet, timestamp: float = None) -> None:
+        """Add packet as a new row."""
+        columns = self.columns
+        encode = self.encode
+        columns['time'].append(float('nan') if timestamp is None else timestamp)
+        columns['type'].append(encode('type', packet.type))
+        columns['who'].append(encode('who', packet.who))
+        columns['what'].append(encode('what', packet.what))
+        columns['legrand_id'].append(int(packet.legrand_id) if packet.legrand_id else -1)
+        columns['unit'].append(int(packet.unit, 16) if packet.unit else -1)
+        columns['mode'].append(encode('mode', packet.mode))
+        columns['media'].append(encode('media', packet.media))
+        columns['dimension'].append(encode('dimension', packet.dimension))
+        if packet.val:
+            self.val_values.extend(int(value) for value in packet.val)
+        self.val_offsets.append(len(self.val_values))
+
+    def extend(self, decoded: Iterable[tuple]) -> None:
+        """Add (timestamp, frame, packet) rows, as yielded by decoder.decode_file."""
+        append = self.append
+        for timestamp, _, packet in decoded:
+            append(packet, timestamp)
+
+    def value(self, name: str, row: int):
+        """Return decoded value of a column at row, for inspection."""
+        value = self.columns[name][row]
+        if name in self.dictionaries:
+            return None if value < 0 else self.dictionaries[name][value]
+        return value
+
+    def vals(self, row: int) -> List[int]:
+        """Return dimension values of row."""
+        return list(self.val_values[self.val_offsets[row]:self.val_offsets[row + 1]])
+
+    def to_numpy(self) -> Dict[str, object]:
+        """Return table as NumPy arrays.
+
+        'packets' is a structured array of the row columns, next to
+        'val_offsets', 'val_values' and a 'dict_<column>' string array per
+        dictionary encoded column.
+        """
+        import numpy
+
+        packets = numpy.empty(len(self), dtype=[
+            (name, NUMPY_TYPES[code]) for name, code in COLUMNS])
+        for name, code in COLUMNS:
+            packets[name] = numpy.frombuffer(self.columns[name],
+                                             dtype=NUMPY_TYPES[code])
+        arrays = {
+            'packets': packets,
+            'val_offsets': numpy.frombuffer(self.val_offsets, dtype='i8'),
+            'val_values': numpy.frombuffer(self.val_values, dtype='i8'),
+        }
+        for name, values in self.dictionaries.items():
+            arrays['dict_' + name] = numpy.array(values, dtype=str)
+        return arrays
+
+    def save(self, path: str) -> None:
+        """Save table as a compressed NumPy .npz file."""
+        import numpy
+
+        numpy.savez_compressed(path, **self.to_numpy())
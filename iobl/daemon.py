@@ -0,0 +1,90 @@
+"""Daemon holding the gateway connection for local clients.
+
+Commands are received from a Unix socket, see client.py for the wire
+format, and sent through a ConnectionSupervisor so that the gateway link
+survives disconnections.
+"""
+import asyncio
+import json
+import logging
+import os
+
+from .client import SOCKET_PATH
+from .protocol import (
+    CommandError,
+    CommandNack,
+    CommandTimeout,
+    ConnectionSupervisor
+)
+
+log = logging.getLogger(__name__)
+
+
+class Daemon:
+    """Serve commands of Unix socket clients through one gateway link."""
+
+    def __init__(self, path: str = SOCKET_PATH, loop=None, **kwargs) -> None:
+        """Initialize daemon.
+
+        Keyword arguments are passed on to ConnectionSupervisor.
+        """
+        self.path = path
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.supervisor = ConnectionSupervisor(loop=self.loop, **kwargs)
+        self.server = None  # type: asyncio.AbstractServer
+
+    @asyncio.coroutine
+    def start(self):
+        """Connect to the gateway and start listening for clients."""
+        yield from self.supervisor.connect()
+        if os.path.exists(self.path):
+            # left over by a previous daemon
+            os.unlink(self.path)
+        self.server = yield from asyncio.start_unix_server(
+            self.handle_client, self.path)
+        os.chmod(self.path, 0o600)
+        log.info('listening on %s', self.path)
+
+    @asyncio.coroutine
+    def handle_client(self, reader, writer):
+        """Answer requests of a client until it disconnects."""
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+                answer = yield from self.handle_request(line)
+                writer.write(json.dumps(answer).encode() + b'\n')
+        except ConnectionError:
+            log.debug('client connection lost')
+        finally:
+            writer.close()
+
+    @asyncio.coroutine
+    def handle_request(self, line: bytes) -> dict:
+        """Send the packet of a request line, return the answer."""
+        try:
+            fields = json.loads(line.decode())
+            if not isinstance(fields, dict):
+                raise ValueError('request is not an object')
+            for key in ('legrand_id', 'unit'):
+                if fields.get(key) is not None:
+                    fields[key] = str(fields[key])
+            packet = yield from self.supervisor.send_packet(fields)
+        except CommandNack as exc:
+            return {'error': 'nack', 'message': str(exc)}
+        except CommandTimeout as exc:
+            return {'error': 'timeout', 'message': str(exc)}
+        except CommandError as exc:
+            return {'error': 'error', 'message': str(exc)}
+        except (ValueError, KeyError, TypeError) as exc:
+            return {'error': 'invalid', 'message': str(exc)}
+        return {'result': packet.type}
+
+    def close(self):
+        """Stop serving and close gateway connection."""
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.supervisor.close()
@@ -0,0 +1,132 @@
+"""Streaming decoding of capture files and raw frame logs.
+
+Files are read in bounded memory and decoded as a generator, invalid
+frames being counted instead of raising. Large files can be decoded by a
+process pool, chunk by chunk, results keeping the file order.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .capture import MAGIC, open_capture, read_frames
+from .parser import classify_packet, decode_match
+
+# bytes read at once from raw frame logs
+READ_SIZE = 1 << 16
+# frames per chunk handed to a worker process
+CHUNK_FRAMES = 10000
+
+
+def iter_frames(path: str) -> Iterator[Tuple[Optional[float], str]]:
+    """Yield (timestamp, frame) of a capture file or raw frame log.
+
+    Capture files (see capture.py) have timestamps, other files are taken
+    as raw frames ending with '##', anything before the leading '*' of a
+    frame (line breaks, log prefixes) being skipped; their timestamps are
+    None.
+    """
+    with open_capture(path) as file:
+        is_capture = file.read(len(MAGIC)) == MAGIC
+    if is_capture:
+        for timestamp, frame in read_frames(path):
+            yield timestamp, frame.decode('latin-1')
+        return
+
+    with open_capture(path) as file:
+        pending = b''
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            *frames, pending = (pending + data).split(b'##')
+            for frame in frames:
+                start = frame.find(b'*')
+                if start == -1:
+                    if frame.strip():
+                        # not a frame at all, let decoding count it
+                        yield None, frame.strip().decode('latin-1') + '##'
+                    continue
+                yield None, frame[start:].decode('latin-1') + '##'
+        if pending.strip():
+            yield None, pending.strip().decode('latin-1')
+
+
+def decode_frames(frames: Iterable[Tuple[Optional[float], str]],
+                  metrics=None) -> Iterator[tuple]:
+    """Yield (timestamp, frame, packet) of every valid frame.
+
+    metrics: metrics.Metrics whose frames_received/frames_decoded/
+    frames_invalid and bytes_in are updated.
+    """
+    for timestamp, frame in frames:
+        if metrics is not None:
+            metrics.frames_received += 1
+            metrics.bytes_in += len(frame)
+        match = classify_packet(frame)
+        packet = None
+        if match is not None:
+            try:
+                packet = decode_match(match)
+            except Exception:
+                # well formed frame with fields the parser can't make sense of
+                pass
+        if packet is None:
+            if metrics is not None:
+                metrics.frames_invalid += 1
+            continue
+        if metrics is not None:
+            metrics.frames_decoded += 1
+        yield timestamp, frame, packet
+
+
+def _decode_chunk(chunk: List[Tuple[Optional[float], str]]):
+    """Decode a chunk of frames in a worker, return results and invalid count."""
+    results = list(decode_frames(chunk))
+    return results, len(chunk) - len(results)
+
+
+def _chunks(frames, size: int):
+    """Group frames into lists of size frames."""
+    chunk = []
+    for frame in frames:
+        chunk.append(frame)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_file(path: str, workers: int = 0, metrics=None,
+                chunk_frames: int = CHUNK_FRAMES) -> Iterator[tuple]:
+    """Yield (timestamp, frame, packet) of every valid frame of a file.
+
+    workers: number of processes decoding chunks of chunk_frames frames,
+    0 to decode in this process. At most two chunks per worker are in
+    progress at any time, so memory stays bounded whatever the file size.
+    """
+    frames = iter_frames(path)
+    if not workers:
+        yield from decode_frames(frames, metrics)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()  # type: deque
+        for chunk in _chunks(frames, chunk_frames):
+            if metrics is not None:
+                metrics.frames_received += len(chunk)
+                metrics.bytes_in += sum(len(frame) for _, frame in chunk)
+            pending.append(executor.submit(_decode_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from _chunk_results(pending.popleft(), metrics)
+        while pending:
+            yield from _chunk_results(pending.popleft(), metrics)
+
+
+def _chunk_results(future, metrics):
+    """Yield results of a worker chunk, counting them."""
+    results, invalid = future.result()
+    if metrics is not None:
+        metrics.frames_decoded += len(results)
+        metrics.frames_invalid += invalid
+    yield from results
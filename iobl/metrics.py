@@ -0,0 +1,126 @@
+"""Runtime metrics of a protocol instance.
+
+Collection is enabled by passing a Metrics instance to the protocol
+(metrics=Metrics()), protocols without one only pay for a None check per
+frame.
+"""
+from bisect import bisect_left
+from typing import Dict, Sequence
+
+# histogram bucket upper bounds, in seconds, from 1µs to 10s
+BOUNDS = tuple(base * 10 ** exp for exp in range(-6, 1) for base in (1, 2, 5)) + (10,)
+
+COUNTERS = ('frames_received', 'frames_decoded', 'frames_invalid',
+            'frames_ignored', 'bytes_in', 'bytes_out', 'acks', 'nacks',
+            'buffer_high_water')
+
+
+class Histogram:
+    """Distribution of durations over fixed logarithmic buckets."""
+
+    __slots__ = ('bounds', 'buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self, bounds: Sequence[float] = BOUNDS) -> None:
+        """Initialize empty histogram, the last bucket being unbounded."""
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None  # type: float
+        self.max = None  # type: float
+
+    def add(self, value: float) -> None:
+        """Record one duration."""
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        """Return mean duration, None if empty."""
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent: float) -> float:
+        """Return upper bound of the bucket holding the given percentile.
+
+        The maximum is returned for values beyond the last bound, None if
+        empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for index, number in enumerate(self.buckets):
+            seen += number
+            if seen >= rank and number:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                break
+        return self.max
+
+    def to_dict(self) -> dict:
+        """Return summary and non empty buckets (by upper bound)."""
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {str(bound): number for bound, number
+                        in zip(self.bounds + ('inf',), self.buckets) if number},
+        }
+
+
+class Metrics:
+    """Counters and histograms updated by the protocol.
+
+    frames_received: frames cut out of the received data.
+    frames_decoded/frames_invalid: frames decoded/dropped as invalid or
+    oversized.
+    frames_ignored: decoded packets dropped by the ignore list.
+    bytes_in/bytes_out: bytes received/written.
+    acks/nacks: command answers from the gateway.
+    buffer_high_water: largest receive buffer size seen.
+    decode_time: duration of packet decoding.
+    ack_latency: delay between writing a command and its ack/nack.
+    """
+
+    __slots__ = COUNTERS + ('decode_time', 'ack_latency')
+
+    def __init__(self) -> None:
+        """Initialize all metrics to zero."""
+        self.reset()
+
+    def reset(self) -> None:
+        """Zero all metrics."""
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self.decode_time = Histogram()
+        self.ack_latency = Histogram()
+
+    def snapshot(self) -> Dict[str, object]:
+        """Return current values as a dict of plain values."""
+        data = {name: getattr(self, name) for name in COUNTERS}
+        data['decode_time'] = self.decode_time.to_dict()
+        data['ack_latency'] = self.ack_latency.to_dict()
+        return data
+
+    def format(self) -> str:
+        """Return metrics as human readable text."""
+        lines = ['%-18s %d' % (name, getattr(self, name)) for name in COUNTERS]
+        for name in ('decode_time', 'ack_latency'):
+            histogram = getattr(self, name)
+            if histogram.count:
+                lines.append('%-18s n=%d mean=%.6fs p50<=%gs p90<=%gs p99<=%gs max=%.6fs' % (
+                    name, histogram.count, histogram.mean,
+                    histogram.percentile(50), histogram.percentile(90),
+                    histogram.percentile(99), histogram.max))
+            else:
+                lines.append('%-18s n=0' % name)
+        return '\n'.join(lines)
@@ -1,10 +1,17 @@
 """Parsers."""
 
 import re
+from collections.abc import Mapping
 from enum import Enum
-from typing import Any, Dict, cast
+from functools import lru_cache
+from operator import attrgetter
+from sys import intern
+from typing import Optional
 
 UNKNOWN = 'unknown'
+# where tokens decoded/encoded kept in cache, a site having a fixed device
+# population, see set_cache_size()
+WHERE_CACHE_SIZE = 1024
 
 DELIM = '*'
 SPECIAL_REQUEST = r'^\*#\d{2,4}\*\*\d{1,2}##$'
@@ -22,6 +29,18 @@ DIMENSION_REQUEST = r'^\*#(\d+)\*(\d*#*\d+#*\d*)\*([\d#\*]+)##$'
 #  *#WHO*WHERE*#DIMENSION*VAL1*VALn##
 DIMENSION_SET = r'^\*#(\d+)\*(\d*#*\d+#*\d*)\*(\d*#*\d+#*\d*)##$'
 
+# all of the above in a single alternation, one named group per packet type
+PACKET = (r'^(?:'
+          r'(?P<bus_command>\*(?P<bc_who>\d+)\*(?P<bc_what>\d+#?\d*#?\d*#?)'
+          r'\*(?P<bc_where>\d*#*\d+#*\d*))'
+          r'|(?P<ack_nack>\*#\*(?P<an_code>[01]))'
+          r'|(?P<status_request>\*#(?P<sr_who>\d+)\*(?P<sr_where>\d*#*\d+#*\d*))'
+          r'|(?P<dimension_request>\*#(?P<dr_who>\d+)\*(?P<dr_where>\d*#*\d+#*\d*)'
+          r'\*(?P<dr_dimension>[\d#\*]+))'
+          r'|(?P<dimension_set>\*#(?P<ds_who>\d+)\*(?P<ds_where>\d*#*\d+#*\d*)'
+          r'\*(?P<ds_dimension>\d*#*\d+#*\d*))'
+          r')##$')
+
 WHERE_DEFINITION = r'(\d+)?#*(\d+)?#*(\d*)$'
 WHAT_DEFINITION = r'(\d+)#?(\d*)#?(\d*)#?'
 DIMENSION_DEFINITION = r'([\d#]+)\*?(\d*)(.*)'
@@ -33,6 +52,7 @@ special_request_re = re.compile(SPECIAL_REQUEST)
 status_request_re = re.compile(STATUS_REQUEST)
 dimension_req_re = re.compile(DIMENSION_REQUEST)
 dimension_set_re = re.compile(DIMENSION_SET)
+packet_re = re.compile(PACKET)
 
 where_decode_re = re.compile(WHERE_DEFINITION)
 what_decode_re = re.compile(WHAT_DEFINITION)
@@ -143,93 +163,259 @@ communication_media = {
     '': 'plc',
     }
 
+# """bus command table per device class, and whether commands are
+# identified by the first field of the what token only."""
+command_tables = {
+    'light': (light_command, False),
+    'automation': (automation_command, False),
+    'doorentry': (door_entry_command, False),
+    'scenario': (scenario_command, True),
+    'configuration': (configuration_command, True),
+    'thermoregulation': (thermoregulation_command, True),
+    }
 
-def valid_packet(packet: str) -> bool:
-    """Verify if packet is valid."""
-    return (bool(bus_command_re.match(packet)) |
-            bool(ack_nack_re.match(packet)) |
-            bool(status_request_re.match(packet)) |
-            bool(dimension_req_re.match(packet)) |
-            bool(dimension_set_re.match(packet)))
-
-
-def decode_packet(packet: str) -> dict:
-    """Break packet down into primitives, and do basic interpretation."""
-    if bool(bus_command_re.match(packet)):
-        who, what, where = bus_command_re.match(packet).group(1, 2, 3)
-
-        data = cast(Dict[str, Any], {
-            'who': devicetype.get(who),
-        })
-
-        device_type_name = {v: k for k, v in devicetype.items()}
-        command = what_decode_re.match(what).group(1)
-
-        if who == device_type_name.get('light'):
-            data['what'] = light_command.get(what)
-        elif who == device_type_name.get('automation'):
-            data['what'] = automation_command.get(what)
-        elif who == device_type_name.get('scenario'):
-            data['what'] = scenario_command.get(command)
-        elif who == device_type_name.get('configuration'):
-            data['what'] = configuration_command.get(command)
-        elif who == device_type_name.get('doorentry'):
-            data['what'] = door_entry_command.get(what)
-        elif who == device_type_name.get('thermoregulation'):
-            data['what'] = thermoregulation_command.get(command)
-
-        data['legrand_id'], data['unit'], data['mode'], data['media'] = parse_legrand_id(str(where))
-
-        data['type'] = 'bus_command'
-        data['command'] = ''
-
-    elif bool(ack_nack_re.match(packet)):
-
-        if ack_nack_re.match(packet).group(1) == '0':
-            data = cast(Dict[str, Any], {
-                'type': 'nack',
-                'legrand_id': '',
-            })
-        else:
-            data = cast(Dict[str, Any], {
-                'type': 'ack',
-                'legrand_id': '',
-            })
-
-    elif bool(status_request_re.match(packet)):
-
-        who, where = status_request_re.match(packet).group(1, 2)
-        data = cast(Dict[str, Any], {
-            'type': 'status_request',
-            'who': devicetype.get(who),
-        })
-        data['legrand_id'], data['unit'], data['mode'], data['media'] = parse_legrand_id(str(where))
+# """dimension table per device class."""
+dimension_tables = {
+    'light': light_dimension,
+    'configuration': configuration_dimension,
+    }
 
-    elif bool(dimension_req_re.match(packet)):
+# Codec tables, built once at import time for O(1) lookups both ways.
+devicetype_code = {v: k for k, v in devicetype.items()}
+communication_mode_code = {v: k for k, v in communication_mode.items()}
+communication_media_code = {v: k for k, v in communication_media.items()}
+
+# who code -> (command table, identified by first field)
+command_decode = {devicetype_code[who]: table
+                  for who, table in command_tables.items()}
+# (who, what) -> what code
+command_encode = {(who, name): code
+                  for who, (table, _) in command_tables.items()
+                  for code, name in table.items()}
+# (who code, dimension code) -> dimension
+dimension_decode = {(devicetype_code[who], code): name
+                    for who, table in dimension_tables.items()
+                    for code, name in table.items()}
+# (who, dimension) -> dimension code
+dimension_encode = {(who, name): code
+                    for who, table in dimension_tables.items()
+                    for code, name in table.items()}
+
+
+def _lazy(name: str):
+    """Return property of a field decoded on first access, see Packet.decode()."""
+    def get(self):
+        if self._match is not None:
+            self.decode()
+        return getattr(self, name)
+    return property(get)
+
+
+class Packet(Mapping):
+    """Decoded IOBL packet.
+
+    Fields are read only attributes, also available through the Mapping
+    interface using the keys of the former packet dicts, so existing
+    callbacks keep working; to_dict() returns a plain copy.
+
+    Packets built by decode_match() only decode type, who and the where
+    token upfront, what and dimension values being decoded on first
+    access, so that packets nobody looks at cost little.
+    """
+
+    __slots__ = ('_type', '_who', '_what', '_legrand_id', '_unit', '_mode',
+                 '_media', '_command', '_dimension', '_val', '_match')
+
+    # mapping keys per packet type
+    keys_by_type = {
+        'bus_command': ('who', 'what', 'legrand_id', 'unit', 'mode', 'media',
+                        'type', 'command'),
+        'ack': ('type', 'legrand_id'),
+        'nack': ('type', 'legrand_id'),
+        'status_request': ('type', 'who', 'legrand_id', 'unit', 'mode',
+                           'media'),
+        'dimension_request': ('type', 'who', 'legrand_id', 'unit', 'mode',
+                              'media', 'dimension', 'val'),
+        'dimension_set': ('type', 'who', 'legrand_id', 'unit', 'mode',
+                          'media'),
+    }
 
-        who, where, dimension = dimension_req_re.match(packet).group(1, 2, 3)
-        data = cast(Dict[str, Any], {
-            'type': 'dimension_request',
-            'who': devicetype.get(who),
-        })
-        data['legrand_id'], data['unit'], data['mode'], data['media'] = parse_legrand_id(str(where))
+    def __init__(self, pkt_type: str, legrand_id: str = '', who: str = None,
+                 what: str = None, unit: str = None, mode: str = None,
+                 media: str = None, command: str = None,
+                 dimension: str = None, val: tuple = None) -> None:
+        """Initialize packet fields."""
+        self._type = pkt_type
+        self._legrand_id = legrand_id
+        self._who = who
+        self._what = what
+        self._unit = unit
+        self._mode = mode
+        self._media = media
+        self._command = command
+        self._dimension = dimension
+        self._val = val
+        # classify_packet() match of fields still to decode
+        self._match = None
+
+    type = property(attrgetter('_type'))
+    legrand_id = property(attrgetter('_legrand_id'))
+    who = property(attrgetter('_who'))
+    what = _lazy('_what')
+    unit = property(attrgetter('_unit'))
+    mode = property(attrgetter('_mode'))
+    media = property(attrgetter('_media'))
+    command = property(attrgetter('_command'))
+    dimension = _lazy('_dimension')
+    val = _lazy('_val')
+
+    def decode(self) -> None:
+        """Decode the fields left for later by decode_match()."""
+        match = self._match
+        if match is None:
+            return
+        if self._type == 'bus_command':
+            self._what = decode_what(*match.group('bc_who', 'bc_what'))
+        elif self._type == 'dimension_request':
+            token = match.group('dr_dimension')
+            if dimension_decode_re.match(token):
+                dimension, val = parse_dimension(token)
+                self._dimension, self._val = dimension, tuple(val)
+            else:
+                self._dimension, self._val = token, ()
+        # only once decoded, so a failure doesn't leave fields at None
+        self._match = None
+
+    def __reduce__(self):
+        """Pickle through the constructor."""
+        return (self.__class__, (self.type, self.legrand_id, self.who,
+                                 self.what, self.unit, self.mode, self.media,
+                                 self.command, self.dimension, self.val))
+
+    def __getitem__(self, key):
+        """Return field as if packet was a dict."""
+        if key in self.keys_by_type[self.type]:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        """Iterate over the keys of this packet type."""
+        return iter(self.keys_by_type[self.type])
+
+    def __len__(self):
+        """Return number of keys of this packet type."""
+        return len(self.keys_by_type[self.type])
+
+    def __repr__(self):
+        """Represent packet with its mapping content."""
+        return 'Packet(%r)' % self.to_dict()
+
+    def to_dict(self) -> dict:
+        """Return packet content as a new dict."""
+        data = {key: getattr(self, key) for key in self.keys_by_type[self.type]}
+        if data.get('val') is not None:
+            data['val'] = list(data['val'])
+        return data
+
+
+def classify_packet(packet: str):
+    """Validate and classify packet in a single regex evaluation.
+
+    Returns the match object, its `lastgroup` being the packet type, or
+    None if the packet is not valid.
+    """
+    return packet_re.match(packet)
 
-        data['dimension'], data['val'] = parse_dimension(dimension)
 
-    elif bool(dimension_set_re.match(packet)):
+def valid_packet(packet: str) -> bool:
+    """Verify if packet is valid."""
+    return packet_re.match(packet) is not None
+
+
+def parse_packet(packet: str) -> Optional[Packet]:
+    """Decode packet, or return None if it is not valid."""
+    match = packet_re.match(packet)
+    if match is None:
+        return None
+    return decode_match(match)
+
+
+def decode_packet(packet: str, match=None) -> Packet:
+    """Break packet down into primitives, and do basic interpretation.
+
+    match: result of classify_packet() on packet, if already available.
+    """
+    if match is None:
+        match = packet_re.match(packet)
+        if match is None:
+            raise ValueError('invalid packet: %r' % packet)
+    return decode_match(match)
+
+
+def decode_match(match) -> Packet:
+    """Build packet out of a classify_packet() match.
+
+    The what and dimension fields are decoded on first access.
+    """
+    pkt_type = match.lastgroup
+
+    if pkt_type == 'bus_command':
+        who, where = match.group('bc_who', 'bc_where')
+        legrand_id, unit, mode, media = parse_legrand_id(where)
+        packet = Packet('bus_command', legrand_id, devicetype.get(who),
+                        None, unit, mode, media, '')
+        packet._match = match
+        return packet
+
+    elif pkt_type == 'ack_nack':
+        if match.group('an_code') == '0':
+            return Packet('nack')
+        return Packet('ack')
+
+    elif pkt_type == 'status_request':
+        who, where = match.group('sr_who', 'sr_where')
+        legrand_id, unit, mode, media = parse_legrand_id(where)
+        return Packet('status_request', legrand_id, devicetype.get(who),
+                      None, unit, mode, media)
+
+    elif pkt_type == 'dimension_request':
+        who, where = match.group('dr_who', 'dr_where')
+        legrand_id, unit, mode, media = parse_legrand_id(where)
+        packet = Packet('dimension_request', legrand_id, devicetype.get(who),
+                        None, unit, mode, media)
+        packet._match = match
+        return packet
+
+    elif pkt_type == 'dimension_set':
+        who, where = match.group('ds_who', 'ds_where')
+        legrand_id, unit, mode, media = parse_legrand_id(where)
+        return Packet('dimension_set', legrand_id, devicetype.get(who),
+                      None, unit, mode, media)
+
+
+def dimension_name(who: str, dimension: str) -> str:
+    """Return name of a dimension code of device class who, the code if unknown."""
+    return dimension_decode.get((devicetype_code.get(who), dimension), dimension)
+
+
+def decode_what(who: str, what: str) -> Optional[str]:
+    """Return command name of a bus command what token, None if unknown."""
+    decoder = command_decode.get(who)
+    if decoder is None:
+        return None
+    table, by_command = decoder
+    if by_command:
+        what = what.partition('#')[0]
+    return table.get(what)
 
-        who, where = dimension_set_re.match(packet).group(1, 2)
-        data = cast(Dict[str, Any], {
-            'type': 'dimension_set',
-            'who': devicetype.get(who),
-        })
-        data['legrand_id'], data['unit'], data['mode'], data['media'] = parse_legrand_id(str(where))
 
-    return data
+def parse_legrand_id(where: str):
+    """Extract legrand id from where token, see set_cache_size()."""
+    return _decode_where_cached(where)
 
 
-def parse_legrand_id(where: str):
-    """Extract legrand id from where token."""
+def decode_where(where: str):
+    """Extract (legrand_id, unit, mode, media) from where token, uncached."""
     result = where_decode_re.match(where)
     match1, match2, match3 = result.group(1, 2, 3)
 
@@ -249,7 +435,10 @@ def parse_legrand_id(where: str):
 
 
 def parse_dimension(dimension: str):
-    """Extract dimension and vals from dimension token."""
+    """Extract dimension and vals from dimension token.
+
+    Values end at the first part not being one, e.g. a trailing '*'.
+    """
     decoded_dim, newval, new_dimension = dimension_decode_re.match(dimension).group(1, 2, 3)
 
     val = list()
@@ -257,35 +446,44 @@ def parse_dimension(dimension: str):
         val.append(newval)
 
         while new_dimension:
-            newval, new_dimension = val_decode_re.match(new_dimension).group(1, 2)
+            result = val_decode_re.match(new_dimension)
+            if result is None:
+                break
+            newval, new_dimension = result.group(1, 2)
 
             if newval:
                 val.append(newval)
 
-    return decoded_dim, val
+    return intern(decoded_dim), val
 
 
 def get_id_unit(idstr: str):
-    """Extract the ID part in the ID string."""
-    tmpid = hex(int(idstr))
+    """Extract the ID part in the ID string.
 
-    if len(tmpid) == 7:
-        unitsize = 2
-    else:
-        unitsize = 1
+    The unit is the last hex digit of the number, or the last two when it
+    has five hex digits.
+    """
+    value = int(idstr)
 
-    unit = tmpid[-unitsize:]
-    legrand_id = str(int(tmpid[0:-unitsize], 0))
+    if 0x10000 <= value <= 0xfffff:
+        unit = '%02x' % (value & 0xff)
+        legrand_id = str(value >> 8)
+    else:
+        unit = '%x' % (value & 0xf)
+        legrand_id = str(value >> 4)
 
-    return (legrand_id, unit)
+    # a site has a fixed device population, share the strings
+    return (intern(legrand_id), intern(unit))
 
 
 def encode_packet(packet_fields: dict) -> str:
     """Call the encoding method according packet type."""
     if packet_fields.get('type') == 'bus_command':
         return encode_bus_command(packet_fields)
-    elif packet_fields.get('type') == 'set_dimension':
+    elif packet_fields.get('type') in ('set_dimension', 'dimension_request'):
         return encode_set_dimension(packet_fields)
+    elif packet_fields.get('type') == 'status_request':
+        return encode_status_request(packet_fields)
     else:
         return ''
 
@@ -295,77 +493,93 @@ def encode_bus_command(packet_fields: dict) -> str:
     where = encode_where(packet_fields.get('legrand_id'), packet_fields.get('unit'),
                          packet_fields.get('mode'), packet_fields.get('media'))
 
-    device_type_name = {v: k for k, v in devicetype.items()}
-
-    if packet_fields.get('who') == 'light':
-        light_command_name = {v: k for k, v in light_command.items()}
-        encoded_packet = '*' + device_type_name.get(packet_fields.get('who')) + '*' + light_command_name.get(packet_fields.get('what')) + '*' + where + '##'
-    elif packet_fields.get('who') == 'automation':
-        automation_command_name = {v: k for k, v in automation_command.items()}
-        encoded_packet = '*' + device_type_name.get(packet_fields.get('who')) + '*' + automation_command_name.get(packet_fields.get('what')) + '*' + where + '##'
-    elif packet_fields.get('who') == 'thermoregulation':
-        thermoregulation_command_name = {v: k for k, v in thermoregulation_command.items()}
-        encoded_packet = '*' + device_type_name.get(packet_fields.get('who')) + '*' + thermoregulation_command_name.get(packet_fields.get('what')) + '*' + where + '##'
-    elif packet_fields.get('who') == 'doorentry':
-        door_entry_command_name = {v: k for k, v in door_entry_command.items()}
-        encoded_packet = '*' + device_type_name.get(packet_fields.get('who')) + '*' + door_entry_command_name.get(packet_fields.get('what')) + '*' + where + '##'
-    elif packet_fields.get('who') == 'scenario':
-        scenario_command_name = {v: k for k, v in scenario_command.items()}
-        encoded_packet = '*' + device_type_name.get(packet_fields.get('who')) + '*' + scenario_command_name.get(packet_fields.get('what')) + '*' + where + '##'
-    elif packet_fields.get('who') == 'configuration':
-        configuration_command_name = {v: k for k, v in configuration_command.items()}
-        encoded_packet = '*' + device_type_name.get(packet_fields.get('who')) + '*' + configuration_command_name.get(packet_fields.get('what')) + '*' + where + '##'
-
-    return encoded_packet
+    who = packet_fields.get('who')
+    what = command_encode.get((who, packet_fields.get('what')))
+    if what is None:
+        raise ValueError('unknown command %r for %r' % (packet_fields.get('what'), who))
+
+    return '*' + devicetype_code[who] + '*' + what + '*' + where + '##'
 
 
 def encode_set_dimension(packet_fields: dict) -> str:
     """Encode the input fields into an IOBL set_dimension/dimension_request packet."""
     where = encode_where(packet_fields.get('legrand_id'), packet_fields.get('unit'),
                          packet_fields.get('mode'), packet_fields.get('media'))
-    pkt_values = ''
-    for value in packet_fields.get('values'):
-        pkt_values = pkt_values + '*' + value
 
-    device_type_name = {v: k for k, v in devicetype.items()}
+    who = packet_fields.get('who')
+    dimension = dimension_encode.get((who, packet_fields.get('dimension')))
+    if dimension is None:
+        raise ValueError('unknown dimension %r for %r' % (packet_fields.get('dimension'), who))
 
-    if packet_fields.get('who') == 'light':
-        light_dimension_name = {v: k for k, v in light_dimension.items()}
-        encoded_packet = '*#' + device_type_name.get(packet_fields.get('who')) + '*' + where + '*' + light_dimension_name.get(packet_fields.get('dimension')) + pkt_values + '##'
-    elif packet_fields.get('who') == 'configuration':
-        configuration_dimension_name = {v: k for k, v in configuration_dimension.items()}
-        encoded_packet = '*#' + device_type_name.get(packet_fields.get('who')) + '*' + where + '*' + configuration_dimension_name.get(packet_fields.get('dimension')) + pkt_values + '##'
-    return encoded_packet
+    pkt_values = ''.join('*' + value for value in packet_fields.get('values') or ())
+
+    return '*#' + devicetype_code[who] + '*' + where + '*' + dimension + pkt_values + '##'
+
+
+def encode_status_request(packet_fields: dict) -> str:
+    """Encode the input fields into an IOBL status_request packet."""
+    where = encode_where(packet_fields.get('legrand_id'), packet_fields.get('unit'),
+                         packet_fields.get('mode'), packet_fields.get('media'))
+
+    return '*#' + devicetype_code[packet_fields.get('who')] + '*' + where + '##'
 
 
 def encode_where(legrandid: str, unit: str, com_mode: str, com_media: str) -> str:
-    """Encode the where clause of IOBL packet."""
-    where = encode_id_unit(legrandid, unit)
+    """Encode the where clause of IOBL packet, see set_cache_size()."""
+    return _encode_where_cached(legrandid, unit, com_mode, com_media)
+
 
-    communication_media_name = {v: k for k, v in communication_media.items()}
-    communication_mode_name = {v: k for k, v in communication_mode.items()}
+def encode_where_uncached(legrandid: str, unit: str, com_mode: str,
+                          com_media: str) -> str:
+    """Encode the where clause of IOBL packet, uncached."""
+    where = str(encode_id_unit(legrandid, unit))
 
     if com_mode == 'unicast' or com_mode == 'multicast':
-        if com_media == 'plc':
-            where = str(where)
-        else:
-            where = str(where) + '#' + communication_media_name.get(com_media)
+        if com_media != 'plc':
+            where = where + '#' + communication_media_code[com_media]
 
     elif com_mode == 'broadcast':
         # When in broadcast mode, the legrand_id provided shall be the source address
         if com_media == 'plc':
-            where = communication_mode_name.get('broadcast') + '#' + str(where)
+            where = communication_mode_code['broadcast'] + '#' + where
         else:
-            where = communication_mode_name.get('broadcast') + '#' + str(where) + '#' + communication_media_name.get(com_media)
+            where = communication_mode_code['broadcast'] + '#' + where + '#' + communication_media_code[com_media]
 
     else:
-        where = '#' + str(where)
+        where = '#' + where
 
     return where
 
 
-def encode_id_unit(legrandid: str, unit: str) -> str:
-    """Encode the input legrand_id and unit."""
-    legrandid = hex(int(legrandid))
+def encode_id_unit(legrandid: str, unit: str) -> int:
+    """Encode the input legrand_id and unit (hex digits)."""
+    return (int(legrandid) << 4 * len(unit)) | int(unit or '0', 16)
+
+
+def set_cache_size(size: int) -> None:
+    """Resize and clear the where token decode/encode caches.
+
+    size: number of entries per cache, 0 to disable caching.
+    """
+    global _decode_where_cached, _encode_where_cached
+    if size:
+        _decode_where_cached = lru_cache(size)(decode_where)
+        _encode_where_cached = lru_cache(size)(encode_where_uncached)
+    else:
+        _decode_where_cached = decode_where
+        _encode_where_cached = encode_where_uncached
+
+
+def cache_info() -> dict:
+    """Return hits/misses/maxsize/currsize of the where token caches."""
+    info = {}
+    for name, cached in (('decode_where', _decode_where_cached),
+                         ('encode_where', _encode_where_cached)):
+        if hasattr(cached, 'cache_info'):
+            info[name] = cached.cache_info()._asdict()
+        else:
+            info[name] = None
+    return info
+
 
-    return int(legrandid + unit, 0)
+set_cache_size(WHERE_CACHE_SIZE)
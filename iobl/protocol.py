@@ -1,21 +1,275 @@
 """Asyncio protocol implementation of IOBL."""
 import asyncio
 import logging
+import random
+import sys
+import time
+from collections import deque
 from datetime import timedelta
 from functools import partial
-from typing import Callable, List
-
-from serial_asyncio import create_serial_connection
+from heapq import heappop, heappush
+from itertools import count
+from operator import attrgetter
+from typing import Callable, Dict, List, Optional
 
 from .parser import (
-    valid_packet,
+    classify_packet,
     decode_packet,
+    dimension_name,
     encode_packet
 )
 
 log = logging.getLogger(__name__)
 
 TIMEOUT = timedelta(seconds=5)
+# number of commands sent to the gateway without waiting for their ack
+WINDOW = 1
+# queue_packet priorities, lower values are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 5
+PRIORITY_BULK = 10
+# device classes whose commands set a state, so that a newer command
+# to the same target makes older ones obsolete
+SUPERSEDING = ('light', 'automation', 'thermoregulation')
+# ConnectionSupervisor reconnection delays (seconds) and outbound queue
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+OUTBOUND_QUEUE_SIZE = 100
+OUTBOUND_EXPIRY = timedelta(seconds=60)
+# PacketStream queue size and overflow policies
+STREAM_SIZE = 100
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+# packet fields subscriptions can select on
+SUBSCRIPTION_FIELDS = ('who', 'legrand_id', 'unit', 'what')
+# longest frame accepted before dropping data and resynchronising
+MAX_FRAME_LENGTH = 256
+
+
+class CommandError(Exception):
+    """Command was not acknowledged by the gateway."""
+
+
+class CommandNack(CommandError):
+    """Gateway answered a command with a nack."""
+
+
+class CommandTimeout(CommandError):
+    """Gateway did not answer a command in time."""
+
+
+def command_key(fields):
+    """Return key of the target a command sets, None if not superseding."""
+    if fields.get('who') not in SUPERSEDING:
+        return None
+    if fields.get('type') == 'bus_command':
+        return ('bus_command', fields.get('who'), fields.get('legrand_id'),
+                fields.get('unit'))
+    if fields.get('type') == 'set_dimension':
+        return ('set_dimension', fields.get('who'), fields.get('legrand_id'),
+                fields.get('unit'), fields.get('dimension'))
+    return None
+
+
+def compile_ignore(ignore: List[str]):
+    """Split ignore list into a set of exact entries and a prefix trie.
+
+    The trie is made of nested dicts keyed by character, a None key marking
+    the end of an ignored prefix.
+    """
+    exact = set()
+    prefixes = {}  # type: dict
+    for entry in ignore:
+        if entry.endswith('*'):
+            node = prefixes
+            for char in entry[:-1]:
+                node = node.setdefault(char, {})
+            node[None] = True
+        else:
+            exact.add(entry)
+    return exact, prefixes
+
+
+def loop_argument(loop) -> dict:
+    """Return keyword arguments binding an asyncio queue/event to loop.
+
+    They bind to the default loop when created before Python 3.10, which
+    removed the loop argument and binds them to the running loop instead.
+    """
+    if sys.version_info < (3, 10):
+        return {'loop': loop}
+    return {}
+
+
+def _chain_future(waiter, task):
+    """Pass outcome of task on to waiter."""
+    if waiter.done():
+        return
+    if task.cancelled():
+        waiter.cancel()
+    elif task.exception() is not None:
+        waiter.set_exception(task.exception())
+    else:
+        waiter.set_result(task.result())
+
+
+class QueuedCommand:
+    """Command waiting in the send queue."""
+
+    __slots__ = ('packet', 'priority', 'seq', 'key', 'sent', 'waiters')
+
+    def __init__(self, packet: str, priority: int, seq: int) -> None:
+        """Initialize queue entry."""
+        self.packet = packet
+        self.priority = priority
+        self.seq = seq
+        self.key = None
+        self.sent = False
+        self.waiters = []  # type: List[asyncio.Future]
+
+
+def answer_key(packet):
+    """Return query key a packet answers, None if it answers none.
+
+    bus_command packets answer status queries, dimension_request packets
+    answer queries of their dimension.
+    """
+    if packet.type == 'bus_command':
+        return (packet.who, packet.legrand_id, packet.unit, None)
+    if packet.type == 'dimension_request':
+        return (packet.who, packet.legrand_id, packet.unit,
+                dimension_name(packet.who, packet.dimension))
+    return None
+
+
+class DeviceRegistry:
+    """Last known state of devices, fed by decoded packets.
+
+    States are dicts keyed by (who, legrand_id, unit), holding the last
+    bus command as 'what' and the last values of every dimension.
+    """
+
+    def __init__(self, callback: Callable = None) -> None:
+        """Initialize registry.
+
+        callback: called with key, changed fields and full state whenever
+        a packet changes the state of a device.
+        """
+        self.callback = callback
+        self.devices = {}  # type: Dict[tuple, dict]
+
+    def update(self, packet) -> bool:
+        """Update device state from packet, return whether it changed."""
+        if packet.type == 'bus_command':
+            field, value = 'what', packet.what
+        elif packet.type == 'dimension_request' and packet.val:
+            field = dimension_name(packet.who, packet.dimension)
+            value = packet.val
+        else:
+            return False
+
+        key = (packet.who, packet.legrand_id, packet.unit)
+        state = self.devices.get(key)
+        if state is None:
+            state = self.devices[key] = {}
+        elif state.get(field) == value:
+            return False
+        state[field] = value
+
+        if self.callback:
+            self.callback(key, {field: value}, state)
+        return True
+
+    def get(self, who: str, legrand_id: str, unit: str) -> Optional[dict]:
+        """Return last known state of a device, None if never heard of."""
+        return self.devices.get((who, legrand_id, unit))
+
+
+class PacketStream:
+    """Async iterator over received packets, see PacketHandling.packets().
+
+    Packets are buffered in a bounded queue; what happens when it is full
+    depends on policy:
+    BLOCK: reading from the transport is paused until the consumer
+    catches up, packets of the chunk being processed are kept aside.
+    DROP_OLDEST/DROP_NEWEST: the oldest queued or the new packet is
+    dropped and counted in dropped.
+    """
+
+    def __init__(self, protocol, maxsize: int = STREAM_SIZE,
+                 policy: str = BLOCK, filters: dict = None) -> None:
+        """Initialize stream."""
+        self.protocol = protocol
+        self.policy = policy
+        self.filters = tuple(filters.items()) if filters else ()
+        self.queue = asyncio.Queue(
+            maxsize, **loop_argument(protocol.loop))  # type: asyncio.Queue
+        self.overflow = deque()  # type: deque
+        self.dropped = 0
+        self.paused = False
+        self.closed = False
+
+    def __aiter__(self):
+        """Return async iterator."""
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        """Return next packet, waiting for one if needed."""
+        if self.closed and self.queue.empty() and not self.overflow:
+            raise StopAsyncIteration
+        packet = yield from self.queue.get()
+        while self.overflow and not self.queue.full():
+            self.queue.put_nowait(self.overflow.popleft())
+        if (self.paused and not self.overflow and
+                self.queue.qsize() <= self.queue.maxsize // 2):
+            self.paused = False
+            self.protocol.resume_stream(self)
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+    def feed(self, packet):
+        """Queue packet if it matches the stream filters."""
+        for name, value in self.filters:
+            if getattr(packet, name) != value:
+                return
+        self.put(packet)
+
+    def put(self, packet):
+        """Queue packet, applying overflow policy."""
+        if self.overflow:
+            self.overflow.append(packet)
+            return
+        try:
+            self.queue.put_nowait(packet)
+        except asyncio.QueueFull:
+            if self.policy == DROP_NEWEST and packet is not None:
+                self.dropped += 1
+            elif self.policy == DROP_OLDEST:
+                self.queue.get_nowait()
+                self.queue.put_nowait(packet)
+                self.dropped += 1
+            else:
+                self.overflow.append(packet)
+                if not self.paused:
+                    self.paused = True
+                    self.protocol.pause_stream(self)
+
+    def close(self):
+        """End iteration once queued packets are consumed."""
+        if self.closed:
+            return
+        self.closed = True
+        self.paused = False
+        self.protocol.remove_stream(self)
+        # wake up consumer waiting on an empty queue, a full queue must not
+        # pause reading again
+        if self.overflow or self.queue.full():
+            self.overflow.append(None)
+        else:
+            self.queue.put_nowait(None)
 
 
 class ProtocolBase(asyncio.Protocol):
@@ -23,15 +277,41 @@ class ProtocolBase(asyncio.Protocol):
 
     transport = None  # type: asyncio.Transport
 
-    def __init__(self, loop=None, disconnect_callback=None) -> None:
-        """Initialize class."""
+    def __init__(self, loop=None, disconnect_callback=None,
+                 max_frame_length: int = MAX_FRAME_LENGTH,
+                 rate: float = None, burst: int = 1, recorder=None,
+                 metrics=None) -> None:
+        """Initialize class.
+
+        max_frame_length: pending data longer than this without a frame
+        terminator is discarded up to the next frame start marker.
+        rate: maximum number of frames written per second, None for no limit.
+        burst: number of frames that can be written at once within rate.
+        recorder: capture.FrameRecorder receiving every raw frame.
+        metrics: metrics.Metrics to update, None to not collect metrics.
+        """
         if loop:
             self.loop = loop
         else:
             self.loop = asyncio.get_event_loop()
         self.packet = ''
-        self.buffer = ''
+        self.buffer = bytearray()
+        # offset from which to resume looking for a frame terminator
+        self._scan_offset = 0
+        self.max_frame_length = max_frame_length
+        # invalid/oversized frames and line noise thrown away
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
         self.disconnect_callback = disconnect_callback
+        self.recorder = recorder
+        self.metrics = metrics
+        # token bucket pacing of outgoing frames
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refill_time = self.loop.time()
+        self._outgoing = deque()  # type: deque
+        self._flush_handle = None  # type: asyncio.Handle
 
     def connection_made(self, transport):
         """Just logging for now."""
@@ -40,31 +320,137 @@ class ProtocolBase(asyncio.Protocol):
 
     def data_received(self, data):
         """Add incoming data to buffer."""
-        data = data.decode()
-        log.debug('received data: %s', data.strip())
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('received data: %s', data.strip())
         self.buffer += data
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.bytes_in += len(data)
+            if len(self.buffer) > metrics.buffer_high_water:
+                metrics.buffer_high_water = len(self.buffer)
         self.handle_lines()
 
     def handle_lines(self):
-        """Assemble incoming data into per-message packets."""
-        while "##" in self.buffer:
-            line, self.buffer = self.buffer.split("##", 1)
-            if valid_packet(line + '##'):
-                self.handle_raw_packet(line + '##')
+        """Assemble incoming data into per-message packets.
+
+        Frames are cut out of the receive buffer in a single forward scan,
+        the consumed part of the buffer being released once per call.
+        """
+        buffer = self.buffer
+        metrics = self.metrics
+        start = 0
+        end = buffer.find(b'##', self._scan_offset)
+        while end != -1:
+            end += 2
+            if metrics is not None:
+                metrics.frames_received += 1
+            if end - start > self.max_frame_length:
+                # as resync() does, keep at most max_frame_length bytes
+                # starting at a '*'
+                tail = buffer.find(b'*', end - self.max_frame_length, end)
+                if tail == -1:
+                    tail = end
+                self.dropped_frames += 1
+                self.dropped_bytes += tail - start
+                log.warning('oversized frame, dropping %d bytes', tail - start)
+                start = tail
+                if start == end:
+                    if metrics is not None:
+                        metrics.frames_invalid += 1
+                    end = buffer.find(b'##', start)
+                    continue
+            if self.recorder is not None:
+                self.recorder.record(bytes(buffer[start:end]))
+            line = buffer[start:end].decode('latin-1')
+            start = end
+            match = classify_packet(line)
+            if match:
+                self.handle_raw_packet(line, match)
             else:
-                log.warning('dropping invalid data: %s', line + '##')
+                if metrics is not None:
+                    metrics.frames_invalid += 1
+                self.dropped_frames += 1
+                self.dropped_bytes += len(line)
+                log.warning('dropping invalid data: %s', line)
+            end = buffer.find(b'##', start)
+
+        if start:
+            del buffer[:start]
+
+        if len(buffer) > self.max_frame_length:
+            self.resync()
+        # a trailing '#' may be the first half of the next terminator
+        self._scan_offset = max(len(buffer) - 1, 0)
+
+    def resync(self):
+        """Drop unterminated data up to a frame start marker.
 
-    def handle_raw_packet(self, raw_packet: bytes) -> None:
-        """Handle one raw incoming packet."""
+        Keeps at most max_frame_length bytes, starting at a '*'.
+        """
+        buffer = self.buffer
+        start = buffer.find(b'*', len(buffer) - self.max_frame_length)
+        if start == -1:
+            start = len(buffer)
+        log.warning('no frame terminator in %d bytes, dropping %d bytes',
+                    len(buffer), start)
+        self.dropped_frames += 1
+        self.dropped_bytes += start
+        del buffer[:start]
+
+    def handle_raw_packet(self, raw_packet: str, match=None) -> None:
+        """Handle one raw incoming packet.
+
+        match: classify_packet() result for raw_packet, if available.
+        """
         raise NotImplementedError()
 
     def send_raw_packet(self, packet: str):
         """Encode and put packet string onto write buffer."""
-        log.debug('writing data: %s', repr(packet))
-        self.transport.write(packet.encode())
+        self.send_raw_packets((packet,))
+
+    def send_raw_packets(self, packets):
+        """Encode and queue packet strings for writing.
+
+        Frames queued during the same loop iteration are written at once,
+        as far as the rate budget allows, the rest being written as the
+        budget refills.
+        """
+        for packet in packets:
+            log.debug('writing data: %r', packet)
+            self._outgoing.append(packet.encode())
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush_outgoing)
+
+    def _flush_outgoing(self):
+        """Write as many queued frames as the rate budget allows."""
+        self._flush_handle = None
+        outgoing = self._outgoing
+        if self.rate:
+            now = self.loop.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._refill_time) * self.rate)
+            self._refill_time = now
+            frames = min(int(self._tokens), len(outgoing))
+            self._tokens -= frames
+        else:
+            frames = len(outgoing)
+
+        if frames:
+            data = b''.join([outgoing.popleft() for _ in range(frames)])
+            if self.metrics is not None:
+                self.metrics.bytes_out += len(data)
+            self.transport.write(data)
+        if outgoing:
+            self._flush_handle = self.loop.call_later(
+                (1 - self._tokens) / self.rate, self._flush_outgoing)
 
     def connection_lost(self, exc):
         """Log when connection is closed, if needed call callback."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # nowhere to write them anymore
+        self._outgoing.clear()
         if exc:
             log.exception('disconnected due to exception')
         else:
@@ -77,58 +463,379 @@ class PacketHandling(ProtocolBase):
     """Handle translating iobl packets to/from python primitives."""
 
     def __init__(self, *args, packet_callback: Callable = None,
+                 ack_timeout: timedelta = TIMEOUT, retries: int = 0,
+                 window: int = WINDOW, query_ttl: float = 0,
+                 raw_callback: Callable = None, decode_packets: bool = True,
                  **kwargs) -> None:
         """Add packethandling specific initialization.
 
         packet_callback: called with every complete/valid packet
         received.
+        raw_callback: called with every valid raw frame (str), before
+        decoding.
+        decode_packets: when False, frames are only passed on to
+        raw_callback, acks/nacks excepted.
+        ack_timeout: delay to wait for the gateway ack of a command, and
+        for the answer to a query.
+        retries: number of times a command is resent after a timeout.
+        window: maximum number of commands awaiting their ack.
+        query_ttl: seconds during which query answers are served from
+        cache, 0 to disable caching.
         """
         super().__init__(*args, **kwargs)
         if packet_callback:
             self.packet_callback = packet_callback
+        self.raw_callback = raw_callback
+        self.decode_packets = decode_packets
+        self.ack_timeout = ack_timeout.total_seconds()
+        self.retries = retries
+        self.window = window
+        # created on first use, to bind to the running loop
+        self._window = None  # type: asyncio.Semaphore
+        # futures of sent commands, in the order the gateway answers them
+        self._pending_acks = deque()  # type: deque
+        # queue_packet heap, superseding commands by key, and sender task
+        self._send_queue = []  # type: list
+        self._send_pending = {}  # type: dict
+        self._send_seq = count()
+        self._sender = None  # type: asyncio.Task
+        # in flight queries and cached answers, by answer_key()
+        self.query_ttl = query_ttl
+        self._queries = {}  # type: Dict[tuple, asyncio.Future]
+        self._query_cache = {}  # type: Dict[tuple, tuple]
+        # packets() iterators, and those waiting for their consumer
+        self._streams = []  # type: List[PacketStream]
+        self._paused_streams = set()  # type: set
 
-    def handle_raw_packet(self, raw_packet):
-        """Parse raw packet string into packet dict."""
+    def handle_raw_packet(self, raw_packet, match=None):
+        """Parse raw packet string into Packet."""
         log.debug('got packet: %s', raw_packet)
+        if self.raw_callback is not None:
+            self.raw_callback(raw_packet)
+        if not self.decode_packets:
+            if match is None:
+                match = classify_packet(raw_packet)
+            if match is not None and match.lastgroup == 'ack_nack':
+                self.handle_response(decode_packet(raw_packet, match))
+            return
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
         packet = None
         try:
-            packet = decode_packet(raw_packet)
+            packet = decode_packet(raw_packet, match)
         except:
             log.exception('failed to parse packet: %s', packet)
+        if metrics is not None:
+            metrics.decode_time.add(time.perf_counter() - started)
+            if packet:
+                metrics.frames_decoded += 1
+            else:
+                metrics.frames_invalid += 1
 
         log.debug('decoded packet: %s', packet)
 
         if packet:
-            if 'ack' in packet or 'nack' in packet:
+            if packet.type == 'ack' or packet.type == 'nack':
                 # handle response packets internally
                 log.debug('command response: %s', packet)
+                self.handle_response(packet)
             else:
+                if self._queries or self.query_ttl:
+                    self.handle_answer(packet)
+                for stream in self._streams:
+                    stream.feed(packet)
                 self.handle_packet(packet)
         else:
             log.warning('no valid packet')
 
     def handle_packet(self, packet):
-        """Process incoming packet dict and optionally call callback."""
+        """Process incoming Packet and optionally call callback."""
         if self.packet_callback:
             # forward to callback
             self.packet_callback(packet)
         else:
             print('packet', packet)
 
+    def packets(self, maxsize: int = STREAM_SIZE, policy: str = BLOCK,
+                **filters) -> PacketStream:
+        """Return async iterator over received packets.
+
+        Keyword arguments (who, legrand_id, unit, type...) restrict the
+        stream to packets with these field values, e.g.:
+
+            async for packet in protocol.packets(who='light'):
+                await handle(packet)
+        """
+        stream = PacketStream(self, maxsize, policy, filters)
+        self._streams.append(stream)
+        return stream
+
+    def remove_stream(self, stream):
+        """Stop feeding a stream."""
+        if stream in self._streams:
+            self._streams.remove(stream)
+        self.resume_stream(stream)
+
+    def pause_stream(self, stream):
+        """Pause reading while stream is full."""
+        if not self._paused_streams and self.transport is not None:
+            log.debug('pausing reading, stream full')
+            self.transport.pause_reading()
+        self._paused_streams.add(stream)
+
+    def resume_stream(self, stream):
+        """Resume reading once no stream is full anymore."""
+        if stream not in self._paused_streams:
+            return
+        self._paused_streams.discard(stream)
+        if not self._paused_streams and self.transport is not None:
+            log.debug('resuming reading')
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        """End packet streams and fail commands awaiting their ack."""
+        for stream in list(self._streams):
+            stream.close()
+        while self._pending_acks:
+            waiter = self._pending_acks.popleft()
+            if not waiter.done():
+                waiter.set_exception(CommandError('connection lost'))
+        super().connection_lost(exc)
+
+    def handle_response(self, packet):
+        """Resolve the oldest command waiting for an ack/nack."""
+        if not self._pending_acks:
+            log.debug('unexpected command response: %s', packet)
+            return
+        waiter = self._pending_acks.popleft()
+        if self.metrics is not None:
+            if packet.type == 'ack':
+                self.metrics.acks += 1
+            else:
+                self.metrics.nacks += 1
+        if waiter.done():
+            # command cancelled once sent, the response still is its own
+            log.debug('response to cancelled command: %s', packet)
+        elif packet.type == 'ack':
+            waiter.set_result(packet)
+        else:
+            waiter.set_exception(CommandNack('command rejected by gateway'))
+
+    def handle_answer(self, packet):
+        """Resolve queries answered by packet, and refresh query cache."""
+        key = answer_key(packet)
+        if key is None:
+            return
+        if self.query_ttl:
+            self._query_cache[key] = (self.loop.time(), packet)
+        waiter = self._queries.get(key)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(packet)
+
+    @asyncio.coroutine
+    def query_status(self, who: str, legrand_id: str, unit: str,
+                     mode: str = 'unicast', media: str = 'plc'):
+        """Request status of a device, returns the bus_command answer."""
+        return (yield from self.query(who, legrand_id, unit, None,
+                                      mode, media))
+
+    @asyncio.coroutine
+    def query_dimension(self, who: str, legrand_id: str, unit: str,
+                        dimension: str, mode: str = 'unicast',
+                        media: str = 'plc'):
+        """Request dimension of a device, returns the dimension_request answer."""
+        return (yield from self.query(who, legrand_id, unit, dimension,
+                                      mode, media))
+
+    @asyncio.coroutine
+    def query(self, who, legrand_id, unit, dimension=None,
+              mode='unicast', media='plc'):
+        """Query device status (no dimension) or dimension.
+
+        Concurrent queries for the same device and dimension share a single
+        request frame; answers younger than query_ttl are served from cache.
+        """
+        key = (who, legrand_id, unit, dimension)
+        if self.query_ttl:
+            cached = self._query_cache.get(key)
+            if cached and self.loop.time() - cached[0] < self.query_ttl:
+                return cached[1]
+
+        waiter = self._queries.get(key)
+        if waiter is None:
+            fields = {
+                'type': 'dimension_request' if dimension else 'status_request',
+                'who': who,
+                'legrand_id': legrand_id,
+                'unit': unit,
+                'mode': mode,
+                'media': media,
+                'dimension': dimension,
+            }
+            # encoded first, so that an invalid query leaves nothing behind
+            packet = encode_packet(fields)
+            waiter = asyncio.Future(loop=self.loop)
+            self._queries[key] = waiter
+            self.loop.create_task(self._run_query(key, packet, waiter))
+        # one caller giving up must not cancel the query for the others
+        return (yield from asyncio.shield(waiter))
+
+    @asyncio.coroutine
+    def _run_query(self, key, packet, waiter):
+        """Send query frame and wait for its answer."""
+        try:
+            yield from self.send_acknowledged(packet)
+            yield from asyncio.wait_for(asyncio.shield(waiter), self.ack_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.set_exception(CommandTimeout('no answer to %s' % packet))
+        except CommandError as exc:
+            if not waiter.done():
+                waiter.set_exception(exc)
+        finally:
+            if self._queries.get(key) is waiter:
+                del self._queries[key]
+
     @asyncio.coroutine
     def send_packet(self, fields):
-        """Concat fields and send bus_command packet to gateway."""
-        self.send_raw_packet(encode_packet(fields))
+        """Concat fields and send packet to gateway, wait for its ack.
+
+        Returns the ack packet, raises CommandNack if the gateway rejects
+        the command and CommandTimeout if it stays unanswered.
+        """
+        return (yield from self.send_acknowledged(encode_packet(fields)))
+
+    def get_window(self) -> asyncio.Semaphore:
+        """Return the semaphore limiting commands awaiting their ack."""
+        if self._window is None:
+            self._window = asyncio.Semaphore(self.window)
+        return self._window
+
+    @asyncio.coroutine
+    def send_packets(self, packets):
+        """Send several packets, sharing writes as far as pacing allows.
+
+        Returns the ack packet or CommandError of every packet, in order.
+        """
+        frames = [encode_packet(fields) for fields in packets]
+        return (yield from asyncio.gather(
+            *[self.send_acknowledged(frame) for frame in frames],
+            return_exceptions=True))
+
+    @asyncio.coroutine
+    def send_acknowledged(self, packet: str):
+        """Send raw packet within the window of unacknowledged commands."""
+        window = self.get_window()
+        yield from window.acquire()
+        try:
+            return (yield from self.transmit(packet))
+        finally:
+            window.release()
+
+    @asyncio.coroutine
+    def transmit(self, packet: str):
+        """Send raw packet, wait for its ack and retry on timeout."""
+        for attempt in range(self.retries + 1):
+            waiter = asyncio.Future(loop=self.loop)
+            self._pending_acks.append(waiter)
+            self.send_raw_packet(packet)
+            sent = self.loop.time()
+            try:
+                return (yield from asyncio.wait_for(waiter, self.ack_timeout))
+            except asyncio.TimeoutError:
+                log.warning('no answer to %s (attempt %d)', packet, attempt + 1)
+                # assume the gateway lost it, so that it does not take
+                # the answer to the next command
+                try:
+                    self._pending_acks.remove(waiter)
+                except ValueError:
+                    pass
+            finally:
+                if (self.metrics is not None and waiter.done() and
+                        not waiter.cancelled()):
+                    self.metrics.ack_latency.add(self.loop.time() - sent)
+        raise CommandTimeout('no answer to %s' % packet)
+
+    def queue_packet(self, fields, priority: int = PRIORITY_DEFAULT) -> asyncio.Future:
+        """Queue packet for sending, returns future of its ack.
+
+        Lower priority values are sent first. A queued command for the same
+        target as an older one still waiting in the queue replaces it, see
+        command_key(); futures of replaced commands follow the outcome of
+        the command that replaced them.
+        """
+        packet = encode_packet(fields)
+        waiter = asyncio.Future(loop=self.loop)
+
+        key = command_key(fields)
+        replaced = self._send_pending.get(key) if key else None
+        queued = QueuedCommand(packet, priority, next(self._send_seq))
+        if replaced is not None:
+            log.debug('%s supersedes %s', packet, replaced.packet)
+            # queued behind commands queued meanwhile, so that commands to
+            # the same device keep their order; the replaced entry is
+            # skipped as if already sent
+            replaced.sent = True
+            queued.waiters = replaced.waiters
+        heappush(self._send_queue, (queued.priority, queued.seq, queued))
+        if key:
+            queued.key = key
+            self._send_pending[key] = queued
+        queued.waiters.append(waiter)
+
+        if self._sender is None:
+            self._sender = self.loop.create_task(self._process_send_queue())
+        return waiter
+
+    @asyncio.coroutine
+    def _process_send_queue(self):
+        """Send queued commands as the window allows."""
+        window = self.get_window()
+        try:
+            while self._send_queue:
+                yield from window.acquire()
+                queued = None
+                while self._send_queue and queued is None:
+                    queued = heappop(self._send_queue)[2]
+                    if queued.sent:
+                        queued = None
+                if queued is None:
+                    window.release()
+                    break
+                queued.sent = True
+                if queued.key:
+                    del self._send_pending[queued.key]
+                task = self.loop.create_task(self.transmit(queued.packet))
+                task.add_done_callback(partial(self._queued_done, queued))
+        finally:
+            self._sender = None
+
+    def _queued_done(self, queued, task):
+        """Release window and pass on outcome of a queued command."""
+        self.get_window().release()
+        for waiter in queued.waiters:
+            _chain_future(waiter, task)
 
 
 class EventHandling(PacketHandling):
     """Breaks up packets into individual events with ids'."""
 
     def __init__(self, *args, event_callback: Callable = None,
-                 ignore: List[str] = None, **kwargs) -> None:
-        """Add eventhandling specific initialization."""
+                 ignore: List[str] = None, track_state: bool = False,
+                 state_callback: Callable = None, **kwargs) -> None:
+        """Add eventhandling specific initialization.
+
+        track_state: keep last known device states in self.registry.
+        state_callback: called on device state changes, see DeviceRegistry;
+        implies track_state.
+        """
         super().__init__(*args, **kwargs)
         self.event_callback = event_callback
+        if track_state or state_callback:
+            self.registry = DeviceRegistry(state_callback)
+        else:
+            self.registry = None
         # suppress printing of packets
         if not kwargs.get('packet_callback'):
             self.packet_callback = lambda x: None
@@ -137,13 +844,22 @@ class EventHandling(PacketHandling):
             self.ignore = ignore
         else:
             self.ignore = []
+        self._ignore_exact, self._ignore_prefixes = compile_ignore(self.ignore)
+        # subscribed field names -> (key getter, key -> callbacks)
+        self._subscriptions = {}  # type: Dict[tuple, tuple]
 
     def _handle_packet(self, packet):
         """Event specific packet handling logic."""
-        if self.ignore_event(packet['type'], packet['legrand_id']):
+        if self.ignore_event(packet.type, packet.legrand_id, packet.who):
+            if self.metrics is not None:
+                self.metrics.frames_ignored += 1
             log.debug('ignoring packet with type/id: %s', packet)
             return
         log.debug('got packet: %s', packet)
+        if self.registry is not None:
+            self.registry.update(packet)
+        if self._subscriptions:
+            self.dispatch(packet)
         if self.event_callback:
             self.event_callback(packet)
 
@@ -152,26 +868,95 @@ class EventHandling(PacketHandling):
         self._handle_packet(packet)
         super().handle_packet(packet)
 
-    def ignore_event(self, pkt_type, legrand_id):
-        """Verify event id against list of events to ignore.
+    def subscribe(self, who: str = None, legrand_id: str = None,
+                  unit: str = None, what: str = None,
+                  callback: Callable = None) -> Callable:
+        """Call callback with events matching the given fields.
+
+        Fields left to None match any value. Subscriptions are indexed by
+        the set of fields they give, so dispatching an event costs one
+        lookup per such set in use plus the matching callbacks.
+        Returns a function cancelling the subscription.
+        """
+        if callback is None:
+            raise ValueError('subscribe needs a callback')
+        values = (who, legrand_id, unit, what)
+        names = tuple(name for name, value in zip(SUBSCRIPTION_FIELDS, values)
+                      if value is not None)
+        key = tuple(value for value in values if value is not None)
+        if len(key) == 1:
+            key = key[0]
+
+        entry = self._subscriptions.get(names)
+        if entry is None:
+            getter = attrgetter(*names) if names else lambda packet: ()
+            entry = self._subscriptions[names] = (getter, {})
+        entry[1].setdefault(key, []).append(callback)
+
+        def unsubscribe():
+            """Cancel subscription."""
+            callbacks = entry[1].get(key)
+            if callbacks and callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del entry[1][key]
+                    if not entry[1]:
+                        self._subscriptions.pop(names, None)
+
+        return unsubscribe
+
+    def dispatch(self, packet):
+        """Call subscribers matching packet."""
+        for getter, index in list(self._subscriptions.values()):
+            callbacks = index.get(getter(packet))
+            if callbacks:
+                for callback in list(callbacks):
+                    callback(packet)
+
+    def get_state(self, who: str, legrand_id: str, unit: str) -> Optional[dict]:
+        """Return last known state of a device, if tracking states."""
+        if self.registry is None:
+            return None
+        return self.registry.get(who, legrand_id, unit)
+
+    def ignore_event(self, pkt_type, legrand_id, who=None):
+        """Verify event against list of events to ignore.
+
+        Plain entries match the packet type, device class or legrand id,
+        entries ending with '*' match the start of the legrand id.
 
         >>> e = EventHandling(ignore=[
-        ...   'test1_00',
-        ...   'test2_*',
+        ...   'status_request',
+        ...   'scenario',
+        ...   '123456',
+        ...   '98*',
         ... ])
-        >>> e.ignore_event('test1_00')
+        >>> e.ignore_event('status_request', '111111')
         True
-        >>> e.ignore_event('test2_00')
+        >>> e.ignore_event('bus_command', '111111', 'scenario')
         True
-        >>> e.ignore_event('test3_00')
+        >>> e.ignore_event('bus_command', '123456', 'light')
+        True
+        >>> e.ignore_event('bus_command', '987654', 'light')
+        True
+        >>> e.ignore_event('bus_command', '111111', 'light')
         False
         """
-        for ignore in self.ignore:
-            if (ignore == pkt_type or
-                    (ignore.endswith('*') and
-                     legrand_id.startswith(ignore[:-1]))):
+        exact = self._ignore_exact
+        if exact and (pkt_type in exact or legrand_id in exact or
+                      (who is not None and who in exact)):
+            return True
+
+        node = self._ignore_prefixes
+        if not node:
+            return False
+        for char in legrand_id:
+            if None in node:
                 return True
-        return False
+            node = node.get(char)
+            if node is None:
+                return False
+        return None in node
 
 
 class IoblProtocol(EventHandling):
@@ -181,8 +966,13 @@ class IoblProtocol(EventHandling):
 def create_iobl_connection(port=None, host=None, baud=115200,
                            protocol=IoblProtocol, packet_callback=None,
                            event_callback=None, disconnect_callback=None,
-                           ignore=None, loop=None):
-    """Create IOBL manager class, returns transport coroutine."""
+                           ignore=None, loop=None,
+                           max_frame_length=MAX_FRAME_LENGTH, **kwargs):
+    """Create IOBL manager class, returns transport coroutine.
+
+    Extra keyword arguments (ack_timeout, retries, window...) are passed on
+    to the protocol.
+    """
     # use default protocol if not specified
     protocol = partial(
         protocol,
@@ -191,13 +981,248 @@ def create_iobl_connection(port=None, host=None, baud=115200,
         event_callback=event_callback,
         disconnect_callback=disconnect_callback,
         ignore=ignore if ignore else [],
+        max_frame_length=max_frame_length,
+        **kwargs
     )
 
     # setup serial connection if no transport specified
     if host:
         conn = loop.create_connection(protocol, host, port)
     else:
-        baud = baud
+        # imported here, so that TCP and daemon clients don't need pyserial
+        from serial_asyncio import create_serial_connection
         conn = create_serial_connection(loop, protocol, port, baud)
 
     return conn
+
+
+class ConnectionSupervisor:
+    """Keep a gateway connection up, holding commands during outages.
+
+    Reconnects with jittered exponential backoff whenever the connection
+    is lost. Commands sent while disconnected wait in a bounded queue and
+    are sent in order once connected again, unless they expired meanwhile.
+    """
+
+    def __init__(self, loop=None, reconnect_delay: float = RECONNECT_DELAY,
+                 max_reconnect_delay: float = MAX_RECONNECT_DELAY,
+                 queue_size: int = OUTBOUND_QUEUE_SIZE,
+                 expiry: timedelta = OUTBOUND_EXPIRY,
+                 disconnect_callback: Callable = None,
+                 **kwargs) -> None:
+        """Initialize supervisor.
+
+        reconnect_delay/max_reconnect_delay: bounds of the delay between
+        connection attempts, doubled after each failure.
+        queue_size: maximum number of commands held while disconnected,
+        the oldest being dropped first.
+        expiry: time after which a held command fails with CommandTimeout,
+        instead of being sent.
+        Other keyword arguments are passed on to create_iobl_connection.
+        """
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.queue_size = queue_size
+        self.expiry = expiry.total_seconds()
+        self.disconnect_callback = disconnect_callback
+        self.connection_args = kwargs
+        self.transport = None  # type: asyncio.Transport
+        self.protocol = None  # type: IoblProtocol
+        self._outbound = deque()  # type: deque
+        self._connecting = None  # type: asyncio.Task
+        self._closing = False
+
+    @asyncio.coroutine
+    def connect(self):
+        """Connect to the gateway, retrying until it succeeds."""
+        delay = self.reconnect_delay
+        while not self._closing:
+            try:
+                self.transport, self.protocol = yield from create_iobl_connection(
+                    loop=self.loop, disconnect_callback=self._disconnected,
+                    **self.connection_args)
+            except (OSError, asyncio.TimeoutError) as exc:
+                # full jitter spreads reconnections of several clients
+                wait = random.uniform(delay / 2, delay)
+                log.warning('connection failed (%s), retrying in %.1fs', exc, wait)
+                yield from asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            log.info('connected')
+            self._flush()
+            return self.protocol
+
+    def _disconnected(self, exc):
+        """Schedule reconnection when the connection is lost."""
+        self.transport = None
+        self.protocol = None
+        if self.disconnect_callback:
+            self.disconnect_callback(exc)
+        if not self._closing and self._connecting is None:
+            self._connecting = self.loop.create_task(
+                self._reconnect(self.reconnect_delay))
+
+    def start(self):
+        """Connect in the background, commands being held meanwhile."""
+        if self.protocol is None and self._connecting is None:
+            self._connecting = self.loop.create_task(self._reconnect(0))
+
+    @asyncio.coroutine
+    def _reconnect(self, delay: float):
+        """Connect after delay seconds."""
+        try:
+            if delay:
+                yield from asyncio.sleep(delay)
+            yield from self.connect()
+        finally:
+            self._connecting = None
+
+    @asyncio.coroutine
+    def send_packet(self, fields):
+        """Send packet, holding it while disconnected.
+
+        Returns the ack packet, raises CommandError when the command
+        failed, was dropped from a full queue or expired.
+        """
+        if self.protocol is not None:
+            return (yield from self.protocol.send_packet(fields))
+
+        if len(self._outbound) >= self.queue_size:
+            _, dropped, timer = self._outbound.popleft()
+            timer.cancel()
+            if not dropped.done():
+                dropped.set_exception(CommandError('outbound queue full'))
+        waiter = asyncio.Future(loop=self.loop)
+        timer = self.loop.call_later(self.expiry, self._expire, waiter)
+        self._outbound.append((fields, waiter, timer))
+        try:
+            return (yield from waiter)
+        finally:
+            if waiter.cancelled():
+                self._remove_held(waiter)
+
+    def _remove_held(self, waiter):
+        """Drop the held command of waiter."""
+        for entry in self._outbound:
+            if entry[1] is waiter:
+                self._outbound.remove(entry)
+                entry[2].cancel()
+                return
+
+    def _expire(self, waiter):
+        """Fail a command held for longer than expiry."""
+        self._remove_held(waiter)
+        if not waiter.done():
+            waiter.set_exception(CommandTimeout('command expired while disconnected'))
+
+    def _flush(self):
+        """Send commands held while disconnected, in order."""
+        while self._outbound and self.protocol is not None:
+            fields, waiter, timer = self._outbound.popleft()
+            timer.cancel()
+            if waiter.done():
+                continue
+            task = self.loop.create_task(self.protocol.send_packet(fields))
+            task.add_done_callback(partial(_chain_future, waiter))
+
+    def close(self):
+        """Close connection and fail held commands."""
+        self._closing = True
+        if self._connecting is not None:
+            self._connecting.cancel()
+        while self._outbound:
+            _, waiter, timer = self._outbound.popleft()
+            timer.cancel()
+            if not waiter.done():
+                waiter.set_exception(CommandError('connection closed'))
+        if self.transport is not None:
+            self.transport.close()
+
+
+class GatewayManager:
+    """Several gateways seen as a single one.
+
+    Packets of all gateways are merged into the same callbacks. The
+    gateway a legrand_id is heard on is remembered, so that commands to
+    it are sent through that gateway only; commands to devices not heard
+    of yet are sent through all gateways.
+    """
+
+    def __init__(self, loop=None, packet_callback: Callable = None,
+                 event_callback: Callable = None) -> None:
+        """Initialize manager.
+
+        packet_callback/event_callback: called with packets/events of
+        every gateway.
+        """
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.packet_callback = packet_callback
+        self.event_callback = event_callback
+        self.gateways = {}  # type: Dict[str, ConnectionSupervisor]
+        # legrand_id -> name of the gateway it was last heard on
+        self.routes = {}  # type: Dict[str, str]
+
+    def add_gateway(self, name: str, **kwargs) -> ConnectionSupervisor:
+        """Add a gateway, keyword arguments as for create_iobl_connection.
+
+        The gateway connects in the background, so that an unreachable
+        gateway doesn't hold up the others; commands routed to it are held
+        until it is connected.
+        """
+        gateway = ConnectionSupervisor(
+            loop=self.loop,
+            packet_callback=partial(self._packet_received, name),
+            event_callback=self.event_callback,
+            **kwargs)
+        self.gateways[name] = gateway
+        gateway.start()
+        return gateway
+
+    def _packet_received(self, name, packet):
+        """Learn route to packet source and pass packet on."""
+        if packet.legrand_id:
+            self.routes[packet.legrand_id] = name
+        if self.packet_callback:
+            self.packet_callback(packet)
+
+    def route(self, legrand_id: str) -> List[ConnectionSupervisor]:
+        """Return gateways to send commands for legrand_id through."""
+        gateway = self.gateways.get(self.routes.get(legrand_id))
+        if gateway is not None:
+            return [gateway]
+        return list(self.gateways.values())
+
+    @asyncio.coroutine
+    def send_packet(self, fields):
+        """Send packet through the gateway(s) its target was heard on.
+
+        When sent through several gateways, returns as soon as one of them
+        acknowledges it, cancelling the others, and raises the first error
+        only once all of them failed.
+        """
+        gateways = self.route(fields.get('legrand_id'))
+        if not gateways:
+            raise CommandError('no gateway')
+        if len(gateways) == 1:
+            return (yield from gateways[0].send_packet(fields))
+
+        pending = [self.loop.create_task(gateway.send_packet(fields))
+                   for gateway in gateways]
+        first = pending[0]
+        try:
+            while pending:
+                done, pending = yield from asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise first.exception()
+
+    def close(self):
+        """Close all gateways."""
+        for gateway in self.gateways.values():
+            gateway.close()
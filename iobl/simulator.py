@@ -0,0 +1,268 @@
+"""Simulator of a Legrand 88213 gateway, for load and latency testing.
+
+Usage:
+  iobl-simulator [-v | -vv] [options]
+  iobl-simulator (-h | --help)
+
+Options:
+  -p --port=<port>       TCP port to listen on [default: 8213].
+  --host=<host>          Address to listen on [default: 127.0.0.1].
+  --pty                  Serve over a pseudo terminal instead of TCP, its
+                           device name is printed.
+  --latency=<seconds>    Delay before answering commands [default: 0.01].
+  --jitter=<seconds>     Random extra answer delay [default: 0].
+  --loss=<ratio>         Ratio of commands left unanswered [default: 0].
+  --nack=<ratio>         Ratio of commands answered with a nack [default: 0].
+  --traffic=<rate>       Synthetic frames generated per second [default: 0].
+  --devices=<count>      Size of the synthetic device population [default: 50].
+  --seed=<seed>          Random seed, for reproducible runs.
+  -h --help              Show this screen.
+  -v                     Increase verbosity
+"""
+import asyncio
+import logging
+import os
+import random
+import sys
+import tty
+from typing import List, Tuple
+
+from docopt import docopt
+
+from .parser import encode_packet, valid_packet
+
+log = logging.getLogger(__name__)
+
+ACK = b'*#*1##'
+NACK = b'*#*0##'
+
+# synthetic traffic, per device class: bus commands and dimensions
+TRAFFIC = {
+    'light': (('on', 'off'), ('go_to_level_time',)),
+    'automation': (('move_up', 'move_down', 'move_stop'), ()),
+}
+
+
+def make_devices(count: int, rng=random) -> List[Tuple[str, str, str]]:
+    """Return (who, legrand_id, unit) of a random device population."""
+    return [(rng.choice(sorted(TRAFFIC)), str(rng.randint(100000, 999999)),
+             str(rng.randint(1, 9)))
+            for _ in range(count)]
+
+
+class GatewaySimulator(asyncio.Protocol):
+    """Answer commands like a gateway, and generate bus traffic.
+
+    latency/jitter: answer delay, in seconds.
+    loss/nack: ratio of commands left unanswered/answered with a nack,
+    invalid frames always being answered with a nack.
+    traffic: synthetic bus_command and dimension_request frames sent per
+    second, from devices (see make_devices).
+    """
+
+    def __init__(self, loop=None, latency: float = 0.01, jitter: float = 0,
+                 loss: float = 0, nack: float = 0, traffic: float = 0,
+                 devices: List[Tuple[str, str, str]] = None,
+                 rng=None) -> None:
+        """Initialize simulator."""
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.nack = nack
+        self.traffic = traffic
+        self.rng = rng if rng else random.Random()
+        self.devices = devices if devices else make_devices(50, self.rng)
+        self.transport = None  # type: asyncio.Transport
+        self.buffer = b''
+        self._generator = None  # type: asyncio.Task
+        self.stats = dict.fromkeys(
+            ('received', 'acked', 'nacked', 'lost', 'generated'), 0)
+
+    def connection_made(self, transport):
+        """Start traffic generation."""
+        self.transport = transport
+        log.info('client connected')
+        if self.traffic:
+            self._generator = self.loop.create_task(self.generate())
+
+    def connection_lost(self, exc):
+        """Stop traffic generation."""
+        log.info('client disconnected')
+        self.transport = None
+        if self._generator is not None:
+            self._generator.cancel()
+
+    def data_received(self, data):
+        """Answer every complete frame."""
+        self.buffer += data
+        *frames, self.buffer = self.buffer.split(b'##')
+        for frame in frames:
+            self.stats['received'] += 1
+            frame = frame.decode('latin-1') + '##'
+            if valid_packet(frame):
+                draw = self.rng.random()
+                if draw < self.loss:
+                    self.stats['lost'] += 1
+                    log.debug('losing %s', frame)
+                    continue
+                answer = NACK if draw < self.loss + self.nack else ACK
+            else:
+                answer = NACK
+            self.stats['acked' if answer == ACK else 'nacked'] += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            self.loop.call_later(delay, self.write, answer)
+
+    def write(self, data: bytes):
+        """Write data if still connected."""
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def synthetic_frame(self) -> str:
+        """Return a bus frame from a random device."""
+        who, legrand_id, unit = self.rng.choice(self.devices)
+        commands, dimensions = TRAFFIC[who]
+        fields = {
+            'who': who,
+            'legrand_id': legrand_id,
+            'unit': unit,
+            'mode': 'unicast',
+            'media': 'plc',
+        }
+        if dimensions and self.rng.random() < 0.5:
+            fields['type'] = 'dimension_request'
+            fields['dimension'] = self.rng.choice(dimensions)
+            fields['values'] = [str(self.rng.randint(0, 100)), '0']
+        else:
+            fields['type'] = 'bus_command'
+            fields['what'] = self.rng.choice(commands)
+        return encode_packet(fields)
+
+    @asyncio.coroutine
+    def generate(self):
+        """Send synthetic frames at the configured rate."""
+        interval = 1 / self.traffic
+        deadline = self.loop.time()
+        while self.transport is not None:
+            self.write(self.synthetic_frame().encode())
+            self.stats['generated'] += 1
+            deadline += interval
+            yield from asyncio.sleep(max(deadline - self.loop.time(), 0))
+
+
+class PtyTransport(asyncio.Transport):
+    """Transport over the master side of a pseudo terminal."""
+
+    def __init__(self, loop, protocol, master: int) -> None:
+        """Initialize transport and start reading."""
+        super().__init__()
+        self.loop = loop
+        self.protocol = protocol
+        self.master = master
+        self._closing = False
+        os.set_blocking(master, False)
+        protocol.connection_made(self)
+        loop.add_reader(master, self._read_ready)
+
+    def _read_ready(self):
+        """Pass available data to protocol."""
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # no slave side open at the moment
+            return
+        if data:
+            self.protocol.data_received(data)
+
+    def write(self, data):
+        """Write data to the slave side."""
+        try:
+            os.write(self.master, data)
+        except OSError as exc:
+            log.debug('dropping pty write: %s', exc)
+
+    def is_closing(self):
+        """Return whether transport is closing or closed."""
+        return self._closing
+
+    def close(self):
+        """Close pseudo terminal."""
+        if self._closing:
+            return
+        self._closing = True
+        self.loop.remove_reader(self.master)
+        os.close(self.master)
+        self.protocol.connection_lost(None)
+
+
+def open_pty(loop=None, **kwargs):
+    """Serve a simulator over a new pseudo terminal.
+
+    Keyword arguments are passed on to GatewaySimulator. Returns the
+    transport, the simulator and the device name to connect to.
+    """
+    loop = loop if loop else asyncio.get_event_loop()
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    simulator = GatewaySimulator(loop=loop, **kwargs)
+    transport = PtyTransport(loop, simulator, master)
+    return transport, simulator, name
+
+
+def start_server(host: str = '127.0.0.1', port: int = 8213, loop=None,
+                 **kwargs):
+    """Serve simulators over TCP, returns server coroutine.
+
+    Every client gets its own simulator, keyword arguments being passed
+    on to GatewaySimulator.
+    """
+    loop = loop if loop else asyncio.get_event_loop()
+    return loop.create_server(
+        lambda: GatewaySimulator(loop=loop, **kwargs), host, port)
+
+
+def main(argv=sys.argv[1:], loop=None):
+    """Parse argument and run simulator until interrupted."""
+    args = docopt(__doc__, argv=argv)
+
+    level = logging.ERROR
+    if args['-v']:
+        level = logging.INFO
+    if args['-v'] == 2:
+        level = logging.DEBUG
+    logging.basicConfig(level=level)
+
+    if not loop:
+        loop = asyncio.get_event_loop()
+
+    rng = random.Random(args['--seed'])
+    options = dict(
+        latency=float(args['--latency']),
+        jitter=float(args['--jitter']),
+        loss=float(args['--loss']),
+        nack=float(args['--nack']),
+        traffic=float(args['--traffic']),
+        devices=make_devices(int(args['--devices']), rng),
+        rng=rng,
+    )
+
+    if args['--pty']:
+        transport, _, name = open_pty(loop=loop, **options)
+        print(name)
+    else:
+        transport = loop.run_until_complete(start_server(
+            args['--host'], int(args['--port']), loop=loop, **options))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        transport.close()
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -97,6 +97,7 @@ setup(
     entry_points={
         'console_scripts': [
             'iobl=iobl.__main__:main',
+            'iobl-simulator=iobl.simulator:main',
         ],
     },
 )
@@ -0,0 +1,42 @@
+"""Capture and replay tests."""
+
+import asyncio
+
+from iobl.capture import FrameRecorder, create_replay_connection, read_frames
+
+FRAMES = [b'*1*1*1969##', b'*1*0*1969##', b'*#1*1969*1*50##']
+
+
+def record(path):
+    """Record FRAMES 50ms apart."""
+    recorder = FrameRecorder(str(path))
+    for index, frame in enumerate(FRAMES):
+        recorder.record(frame, 1000 + index * 0.05)
+    recorder.close()
+
+
+def test_record_read(tmp_path):
+    """Recorded frames are read back with their timestamps."""
+    path = tmp_path / 'frames.cap.gz'
+    record(path)
+    assert list(read_frames(str(path))) == [
+        (1000 + index * 0.05, frame) for index, frame in enumerate(FRAMES)]
+
+
+def test_replay_pause_resume(tmp_path):
+    """Replay on a non-default loop waits while reading is paused."""
+    path = tmp_path / 'frames.cap'
+    record(path)
+    loop = asyncio.new_event_loop()
+    packets = []
+    transport, _ = loop.run_until_complete(create_replay_connection(
+        str(path), loop=loop, packet_callback=packets.append))
+    transport.pause_reading()
+    replayed = len(packets)
+    loop.run_until_complete(asyncio.sleep(0.15))
+    assert len(packets) == replayed < 3
+    transport.resume_reading()
+    assert loop.run_until_complete(transport.done) == 3
+    assert [packet.type for packet in packets] == [
+        'bus_command', 'bus_command', 'dimension_request']
+    loop.close()
@@ -0,0 +1,34 @@
+"""Parser and decoder tests."""
+
+from iobl.decoder import decode_frames
+from iobl.parser import dimension_name, parse_packet
+
+# well formed dimension request with a trailing '*' after its values
+TRAILING_STAR = '*#1*12345*1*2*##'
+
+
+def test_dimension_trailing_star():
+    """Values end at the trailing '*' instead of raising."""
+    packet = parse_packet(TRAILING_STAR)
+    assert packet.dimension == '1'
+    assert packet.val == ('2',)
+    # decoded once, later accesses keep the values
+    assert packet.val == ('2',)
+    assert packet.to_dict()['val'] == ['2']
+
+
+def test_decode_frames_trailing_star():
+    """Decoding a frame log doesn't stop on such frames."""
+    frames = [(None, TRAILING_STAR), (None, '*1*1*1975297##'), (None, 'x##')]
+    results = list(decode_frames(frames))
+    assert [frame for _, frame, _ in results] == [TRAILING_STAR,
+                                                  '*1*1*1975297##']
+    assert results[0][2].val == ('2',)
+
+
+def test_dimension_name():
+    """Dimension codes are named per device class, unknown ones kept."""
+    assert dimension_name('light', '1') == 'go_to_level_time'
+    assert dimension_name('configuration', '13') == 'announce_id'
+    assert dimension_name('light', '99') == '99'
+    assert dimension_name('automation', '1') == '1'
@@ -0,0 +1,431 @@
+"""Protocol tests."""
+
+import asyncio
+import socket
+from datetime import timedelta
+
+import pytest
+
+from iobl.protocol import (
+    BLOCK,
+    DROP_NEWEST,
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    CommandError,
+    CommandNack,
+    CommandTimeout,
+    ConnectionSupervisor,
+    GatewayManager,
+    IoblProtocol
+)
+from iobl.simulator import start_server
+
+ACK = b'*#*1##'
+NACK = b'*#*0##'
+ON = {'type': 'bus_command', 'who': 'light', 'what': 'on',
+      'legrand_id': '123', 'unit': '1', 'mode': 'unicast', 'media': 'plc'}
+OFF = dict(ON, what='off')
+
+
+def test_track_state_trailing_star():
+    """A dimension request ending with '*' updates the registry."""
+    loop = asyncio.new_event_loop()
+    events = []
+    protocol = IoblProtocol(loop=loop, track_state=True,
+                            event_callback=events.append)
+    protocol.data_received(b'*#1*12345*1*2*##')
+    assert len(events) == 1
+    assert protocol.get_state('light', '771', '9') == {
+        'go_to_level_time': ('2',)}
+    loop.close()
+
+
+def test_invalid_query_not_registered():
+    """A query failing to encode doesn't block later queries."""
+    loop = asyncio.new_event_loop()
+    protocol = IoblProtocol(loop=loop)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            loop.run_until_complete(protocol.query_dimension(
+                'light', '123', '1', 'nonexistent'))
+    assert not protocol._queries
+    loop.close()
+
+
+class FakeTransport:
+    """Transport recording written frames and reading pauses."""
+
+    def __init__(self):
+        self.written = []
+        self.writes = 0
+        self.paused = 0
+        self.closed = False
+
+    def write(self, data):
+        self.writes += 1
+        self.written.extend(frame + b'##' for frame in data.split(b'##')[:-1])
+
+    def pause_reading(self):
+        self.paused += 1
+
+    def resume_reading(self):
+        self.paused -= 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('policy', [BLOCK, DROP_NEWEST])
+def test_close_full_stream(policy):
+    """Closing a full stream leaves reading resumed, queued packets kept."""
+    loop = asyncio.new_event_loop()
+    protocol = IoblProtocol(loop=loop)
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    stream = protocol.packets(maxsize=1, policy=policy)
+    protocol.data_received(b'*1*1*1975297##')
+    assert stream.queue.full()
+    stream.close()
+    assert transport.paused == 0
+    assert not protocol._paused_streams
+
+    @asyncio.coroutine
+    def consume():
+        return [packet.what for packet in (yield from _collect(stream))]
+
+    assert loop.run_until_complete(consume()) == ['on']
+    assert transport.paused == 0
+    loop.close()
+
+
+@asyncio.coroutine
+def _collect(stream):
+    """Return the packets left in stream."""
+    packets = []
+    while True:
+        try:
+            packets.append((yield from stream.__anext__()))
+        except StopAsyncIteration:
+            return packets
+
+
+@pytest.mark.parametrize('chunks', [1, 2])
+def test_oversized_frame_resync(chunks):
+    """Noise before a frame is dropped however data is split into reads."""
+    loop = asyncio.new_event_loop()
+    events = []
+    protocol = IoblProtocol(loop=loop, event_callback=events.append)
+    data = b'x' * 300 + b'*1*1*1975297##'
+    if chunks == 1:
+        protocol.data_received(data)
+    else:
+        protocol.data_received(data[:300])
+        protocol.data_received(data[300:])
+    assert [event.what for event in events] == ['on']
+    assert protocol.dropped_bytes == 300
+    loop.close()
+
+
+def connect(loop, **kwargs):
+    """Return protocol connected to a FakeTransport."""
+    protocol = IoblProtocol(loop=loop, **kwargs)
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+def run(loop, seconds=0.01):
+    """Run loop for a while."""
+    loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def test_send_packet_ack_nack():
+    """send_packet returns the ack, raises CommandNack on a nack."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop)
+    task = loop.create_task(protocol.send_packet(ON))
+    run(loop)
+    assert transport.written == [b'*1*1*1969##']
+    protocol.data_received(ACK)
+    assert loop.run_until_complete(task).type == 'ack'
+
+    task = loop.create_task(protocol.send_packet(OFF))
+    run(loop)
+    protocol.data_received(NACK)
+    with pytest.raises(CommandNack):
+        loop.run_until_complete(task)
+    loop.close()
+
+
+def test_send_packet_retries():
+    """Unanswered commands are resent, then fail with CommandTimeout."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(
+        loop, ack_timeout=timedelta(seconds=0.02), retries=2)
+    with pytest.raises(CommandTimeout):
+        loop.run_until_complete(protocol.send_packet(ON))
+    assert transport.written == [b'*1*1*1969##'] * 3
+    loop.close()
+
+
+def test_send_window():
+    """No more than window commands await their ack at once."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop, window=2)
+    tasks = [loop.create_task(protocol.send_packet(dict(ON, unit=unit)))
+             for unit in '123']
+    run(loop)
+    assert len(transport.written) == 2
+    protocol.data_received(ACK)
+    run(loop)
+    assert len(transport.written) == 3
+    assert tasks[0].result().type == 'ack'
+    protocol.data_received(ACK + ACK)
+    loop.run_until_complete(asyncio.gather(*tasks))
+    loop.close()
+
+
+def test_connection_lost_fails_pending():
+    """Commands awaiting their ack fail as soon as the connection is lost."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop, retries=3)
+    task = loop.create_task(protocol.send_packet(ON))
+    run(loop)
+    protocol.connection_lost(None)
+    with pytest.raises(CommandError):
+        loop.run_until_complete(asyncio.wait_for(task, 1))
+    assert not protocol._pending_acks
+    assert not protocol._outgoing
+    loop.close()
+
+
+def test_queue_priority():
+    """Queued commands are sent by priority, then in queuing order."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop)
+    waiters = [protocol.queue_packet(dict(ON, unit='1'), PRIORITY_BULK),
+               protocol.queue_packet(dict(ON, unit='2')),
+               protocol.queue_packet(dict(ON, unit='3'), PRIORITY_INTERACTIVE)]
+    for _ in waiters:
+        run(loop)
+        protocol.data_received(ACK)
+    loop.run_until_complete(asyncio.gather(*waiters))
+    assert transport.written == [b'*1*1*1971##', b'*1*1*1970##',
+                                 b'*1*1*1969##']
+    loop.close()
+
+
+def test_queue_supersede_keeps_device_order():
+    """A superseding command is sent after commands queued before it."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop)
+    level = {'type': 'set_dimension', 'who': 'light', 'legrand_id': '123',
+             'unit': '1', 'mode': 'unicast', 'media': 'plc',
+             'dimension': 'go_to_level_time', 'values': ['50']}
+    waiters = [protocol.queue_packet(ON), protocol.queue_packet(level),
+               protocol.queue_packet(OFF)]
+    for _ in range(2):
+        run(loop)
+        protocol.data_received(ACK)
+    results = loop.run_until_complete(asyncio.gather(*waiters))
+    assert transport.written == [b'*#1*1969*1*50##', b'*1*0*1969##']
+    assert [result.type for result in results] == ['ack'] * 3
+    loop.close()
+
+
+def test_pacing():
+    """Frames are written within the rate budget, batched when possible."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop, rate=50, burst=2)
+    protocol.send_raw_packets(['*1*1*1969##'] * 5)
+    run(loop, 0)
+    assert len(transport.written) == 2
+    assert transport.writes == 1
+    run(loop, 0.03)
+    assert 2 < len(transport.written) < 5
+    run(loop, 0.1)
+    assert len(transport.written) == 5
+    loop.close()
+
+
+def test_unpaced_batching():
+    """Without rate, frames queued together are written at once."""
+    loop = asyncio.new_event_loop()
+    protocol, transport = connect(loop)
+    for unit in '123':
+        protocol.send_raw_packet('*1*1*196%s##' % unit)
+    run(loop, 0)
+    assert len(transport.written) == 3
+    assert transport.writes == 1
+    loop.close()
+
+
+def test_ignore_exact_and_prefix():
+    """Ignore entries match type, class and id exactly, or id prefixes."""
+    loop = asyncio.new_event_loop()
+    protocol = IoblProtocol(loop=loop, ignore=[
+        'status_request', 'scenario', '123456', '98*', '5*'])
+    assert protocol.ignore_event('status_request', '111111')
+    assert protocol.ignore_event('bus_command', '111111', 'scenario')
+    assert protocol.ignore_event('bus_command', '123456', 'light')
+    assert not protocol.ignore_event('bus_command', '1234567', 'light')
+    assert protocol.ignore_event('bus_command', '987654', 'light')
+    assert protocol.ignore_event('bus_command', '98', 'light')
+    assert not protocol.ignore_event('bus_command', '9', 'light')
+    assert protocol.ignore_event('bus_command', '5', 'light')
+    assert not protocol.ignore_event('bus_command', '111111', 'light')
+    loop.close()
+
+
+def test_ignored_packets_not_passed_on():
+    """Ignored packets don't reach the event callback."""
+    loop = asyncio.new_event_loop()
+    events = []
+    protocol = IoblProtocol(loop=loop, ignore=['12*'],
+                            event_callback=events.append)
+    # legrand ids 123 then 771
+    protocol.data_received(b'*1*1*1969##*1*1*12345##')
+    assert [event.legrand_id for event in events] == ['771']
+    loop.close()
+
+
+def start_simulator(loop, port=0, **kwargs):
+    """Start a gateway simulator, return server and its port."""
+    server = loop.run_until_complete(
+        start_server('127.0.0.1', port, loop=loop, latency=0.001, **kwargs))
+    return server, server.sockets[0].getsockname()[1]
+
+
+def stop_simulator(loop, server):
+    """Stop listening for new connections."""
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+
+def test_supervisor_hold_expire_reconnect():
+    """Commands are held while disconnected, expire, or are sent on reconnection."""
+    loop = asyncio.new_event_loop()
+    server, port = start_simulator(loop)
+    supervisor = ConnectionSupervisor(
+        loop=loop, host='127.0.0.1', port=port, reconnect_delay=0.02,
+        max_reconnect_delay=0.05, expiry=timedelta(seconds=0.1))
+    loop.run_until_complete(supervisor.connect())
+    assert loop.run_until_complete(supervisor.send_packet(ON)).type == 'ack'
+
+    # gateway goes away
+    stop_simulator(loop, server)
+    supervisor.transport.close()
+    run(loop)
+    assert supervisor.protocol is None
+
+    with pytest.raises(CommandTimeout):
+        loop.run_until_complete(asyncio.wait_for(supervisor.send_packet(ON), 1))
+    assert not supervisor._outbound
+
+    held = loop.create_task(supervisor.send_packet(OFF))
+    run(loop)
+    assert len(supervisor._outbound) == 1
+    server, _ = start_simulator(loop, port)
+    assert loop.run_until_complete(asyncio.wait_for(held, 1)).type == 'ack'
+    assert supervisor.protocol is not None
+
+    supervisor.close()
+    stop_simulator(loop, server)
+    run(loop)
+    loop.close()
+
+
+def test_stream_waits_on_own_loop():
+    """A consumer can wait on an empty stream of a non-default loop."""
+    loop = asyncio.new_event_loop()
+    protocol, _ = connect(loop)
+    stream = protocol.packets()
+    loop.call_later(0.01, protocol.data_received, b'*1*1*1969##')
+    packet = loop.run_until_complete(asyncio.wait_for(stream.__anext__(), 1))
+    assert packet.what == 'on'
+    stream.close()
+    loop.close()
+
+
+def test_subscriptions():
+    """Subscribers get events matching their fields until unsubscribed."""
+    loop = asyncio.new_event_loop()
+    protocol = IoblProtocol(loop=loop)
+    got = {name: [] for name in ('all', 'light', 'device', 'off', 'other')}
+    protocol.subscribe(callback=got['all'].append)
+    protocol.subscribe(who='light', callback=got['light'].append)
+    unsubscribe = protocol.subscribe(who='light', legrand_id='123', unit='1',
+                                     callback=got['device'].append)
+    protocol.subscribe(legrand_id='123', what='off', callback=got['off'].append)
+    protocol.subscribe(legrand_id='999', callback=got['other'].append)
+
+    # light 123/1 on, off, then automation 123/1 move_up
+    protocol.data_received(b'*1*1*1969##*1*0*1969##*2*1*1969##')
+    assert len(got['all']) == 3
+    assert [event.what for event in got['light']] == ['on', 'off']
+    assert [event.what for event in got['device']] == ['on', 'off']
+    assert [event.what for event in got['off']] == ['off']
+    assert not got['other']
+
+    unsubscribe()
+    protocol.data_received(b'*1*1*1969##')
+    assert len(got['device']) == 2
+    assert len(got['light']) == 3
+    with pytest.raises(ValueError):
+        protocol.subscribe(who='light')
+    loop.close()
+
+
+def unused_port():
+    """Return a TCP port nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_manager_first_ack_with_dead_gateway():
+    """An unreachable gateway holds up neither startup nor commands."""
+    loop = asyncio.new_event_loop()
+    server, port = start_simulator(loop)
+    manager = GatewayManager(loop=loop)
+    options = dict(host='127.0.0.1', reconnect_delay=0.02,
+                   max_reconnect_delay=0.05)
+    live = manager.add_gateway('live', port=port, **options)
+    dead = manager.add_gateway('dead', port=unused_port(), **options)
+    run(loop, 0.05)
+    assert live.protocol is not None
+    assert dead.protocol is None
+
+    # not heard of yet, sent through both gateways
+    result = loop.run_until_complete(
+        asyncio.wait_for(manager.send_packet(ON), 1))
+    assert result.type == 'ack'
+    run(loop)
+    assert not dead._outbound
+
+    # heard on the live gateway, sent through it only
+    live.protocol.data_received(b'*1*1*1969##')
+    assert manager.route('123') == [live]
+    assert manager.route('456') == [live, dead]
+    manager.close()
+    stop_simulator(loop, server)
+    run(loop)
+    loop.close()
+
+
+def test_manager_all_gateways_failing():
+    """The first error is raised once every gateway failed."""
+    loop = asyncio.new_event_loop()
+    server, port = start_simulator(loop, nack=1)
+    manager = GatewayManager(loop=loop)
+    options = dict(host='127.0.0.1', reconnect_delay=0.02,
+                   max_reconnect_delay=0.05, expiry=timedelta(seconds=0.05))
+    manager.add_gateway('live', port=port, **options)
+    manager.add_gateway('dead', port=unused_port(), **options)
+    run(loop, 0.05)
+    with pytest.raises(CommandNack):
+        loop.run_until_complete(asyncio.wait_for(manager.send_packet(ON), 1))
+    manager.close()
+    stop_simulator(loop, server)
+    run(loop)
+    loop.close()